@@ -0,0 +1,220 @@
+"""
+Opt-in asyncio download engine (test.py --async, scrape_icons.py --async,
+build.py --download --async-download); downloader.Downloader stays the default.
+
+AsyncDownloader schedules Downloader.download calls with asyncio.to_thread
+behind an asyncio.Semaphore, so requests keeps doing the HTTP: the keep-alive
+pool, the per-host parallel and rate limits, proxies from the environment,
+the manifest and PNG passthrough or conversion. On top of that it adds:
+
+- Failed attempts are retried with full-jitter exponential backoff. That
+  covers connection errors, timeouts, truncated bodies and 408/425/429/5xx
+  responses; Retry-After is honoured.
+- An optional overall deadline bounds a whole run. Each attempt's read
+  timeout is cut to the time left, and no new attempt or retry starts once it
+  passes.
+
+Bodies stream to disk in CHUNK_SIZE pieces, so at most max_workers bodies are
+in flight at once.
+"""
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from downloader import Downloader, make_summary, print_summary
+
+RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+RETRIES = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 8.0
+
+
+class FetchError(Exception):
+    """A failed attempt. retryable tells whether another attempt may succeed."""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(FetchError):
+    def __init__(self, message="deadline exceeded"):
+        super().__init__(message, retryable=False)
+
+
+def backoff_delay(retry, base=BACKOFF, cap=MAX_BACKOFF):
+    """Full-jitter exponential backoff before the given retry (0-based)."""
+    return random.uniform(0, min(cap, base * 2**retry))
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header in delta-seconds form, else None."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_error(e):
+    """The FetchError for a failed requests attempt."""
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        return FetchError(
+            str(e),
+            retryable=status in RETRY_STATUSES,
+            retry_after=parse_retry_after(e.response.headers.get("Retry-After")),
+        )
+    # Connection errors, timeouts and truncated bodies; bad URLs will not get better
+    retryable = not isinstance(
+        e, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema)
+    )
+    return FetchError(f"{type(e).__name__}: {e}", retryable=retryable)
+
+
+class AsyncDownloader:
+    """
+    The interface of downloader.Downloader, run from an event loop, plus
+    retries and an overall deadline (in seconds from the start of a
+    download()/download_all() call).
+    """
+
+    def __init__(
+        self,
+        max_workers=8,
+        per_host=4,
+        rate=4.0,
+        timeout=10,
+        headers=None,
+        manifest=None,
+        passthrough=True,
+        compress_level=6,
+        optimize=False,
+        retries=RETRIES,
+        backoff=BACKOFF,
+        max_backoff=MAX_BACKOFF,
+        deadline=None,
+    ):
+        self.downloader = Downloader(
+            max_workers=max_workers,
+            per_host=per_host,
+            rate=rate,
+            timeout=timeout,
+            headers=headers,
+            manifest=manifest,
+            passthrough=passthrough,
+            compress_level=compress_level,
+            optimize=optimize,
+        )
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.manifest = manifest
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retried = 0
+        self.deadline_failures = 0
+
+    def close(self):
+        self.downloader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    async def run(self, coroutine):
+        """Run coroutine with the per-call state: worker threads, slots and the deadline."""
+        loop = asyncio.get_running_loop()
+        # to_thread uses the default executor; size it so every slot gets a thread
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_workers))
+        self.slots = asyncio.Semaphore(self.max_workers)
+        self.deadline_at = time.monotonic() + self.deadline if self.deadline else None
+        return await coroutine
+
+    def attempt_timeout(self):
+        if self.deadline_at is None:
+            return self.timeout
+        remaining = self.deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return min(self.timeout, remaining)
+
+    async def download_async(self, url, save_path):
+        retry = 0
+        while True:
+            try:
+                timeout = self.attempt_timeout()
+                return await asyncio.to_thread(self.downloader.download, url, save_path, timeout)
+            except requests.RequestException as e:
+                error = fetch_error(e)
+            if not error.retryable or retry >= self.retries:
+                raise error
+            if error.retry_after is not None:
+                delay = error.retry_after
+            else:
+                delay = backoff_delay(retry, self.backoff, self.max_backoff)
+            if self.deadline_at is not None and time.monotonic() + delay >= self.deadline_at:
+                raise DeadlineExceeded(
+                    f"deadline exceeded after {retry + 1} attempt(s), last: {error}"
+                )
+            retry += 1
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def download_job(self, url, save_path):
+        async with self.slots:
+            start = time.perf_counter()
+            try:
+                result = await self.download_async(url, save_path)
+            except (FetchError, OSError, ValueError) as e:
+                # OSError/ValueError: the file could not be written or decoded
+                if isinstance(e, DeadlineExceeded):
+                    self.deadline_failures += 1
+                print(f"Error downloading {url}: {e}")
+                return None
+            result["elapsed"] = time.perf_counter() - start
+            return result
+
+    def download(self, url, save_path):
+        """Download one image and save it as PNG; raises FetchError when it fails for good."""
+        return asyncio.run(self.run(self.download_async(url, save_path)))
+
+    def download_all(self, jobs):
+        """
+        Download (url, save_path) pairs concurrently. Returns the summary of
+        Downloader.download_all plus retries and deadline failures.
+        """
+        jobs = list(jobs)
+        start = time.perf_counter()
+        retried = self.retried
+        deadline_failures = self.deadline_failures
+
+        async def download_jobs():
+            return await asyncio.gather(
+                *(self.download_job(url, save_path) for url, save_path in jobs)
+            )
+
+        results = asyncio.run(self.run(download_jobs()))
+        elapsed = time.perf_counter() - start
+
+        if self.manifest is not None:
+            self.manifest.save()
+
+        summary = make_summary(len(jobs), results, elapsed)
+        summary["retries"] = self.retried - retried
+        summary["deadline_failures"] = self.deadline_failures - deadline_failures
+        print_summary(summary)
+        if summary["retries"] or summary["deadline_failures"]:
+            print(
+                f"  {summary['retries']} retries, "
+                f"{summary['deadline_failures']} failed on the deadline"
+            )
+        return summary
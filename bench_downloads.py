@@ -0,0 +1,164 @@
+"""
+Offline benchmark for the download engines.
+
+Starts fixture_server.py on a local port with the given latency and failure
+settings, then downloads every PNG in classes/ and subclasses/ from it into a
+temporary directory with the threaded Downloader and/or the asyncio
+AsyncDownloader. Reports files, failures, bytes, MB/s, p50/p95/p99 per-file
+latency and retries per engine, and writes the results as JSON so settings can
+be compared between runs.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from urllib.parse import quote
+
+import fixture_server
+from async_fetch import AsyncDownloader
+from bench_server import free_port, wait_for_port
+from downloader import Downloader
+
+FOLDERS = ("classes", "subclasses")
+ENGINES = ("async", "threads")
+
+
+def fixture_jobs(base_url, output_dir):
+    jobs = []
+    for folder in FOLDERS:
+        for image_file in sorted(os.listdir(folder)):
+            if image_file.endswith(".png"):
+                jobs.append(
+                    (
+                        f"{base_url}/{folder}/{quote(image_file)}",
+                        os.path.join(output_dir, folder, image_file),
+                    )
+                )
+    return jobs
+
+
+def make_engine(engine, args):
+    # No rate limit: the stand-in is local, and the limit would dominate the timings
+    common = {
+        "max_workers": args.workers,
+        "per_host": args.per_host,
+        "rate": 0,
+        "timeout": args.timeout,
+        "manifest": None,
+    }
+    if engine == "async":
+        return AsyncDownloader(retries=args.retries, deadline=args.deadline, **common)
+    return Downloader(**common)
+
+
+def run_engine(engine, args, base_url):
+    output_dir = tempfile.mkdtemp(prefix=f"bench-downloads-{engine}-")
+    try:
+        jobs = fixture_jobs(base_url, output_dir)
+        with make_engine(engine, args) as downloader:
+            start = time.perf_counter()
+            summary = downloader.download_all(jobs)
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    latency = summary["latency"]
+    return {
+        "engine": engine,
+        "files": summary["total"],
+        "failed": summary["failed"],
+        "bytes": summary["bytes"],
+        "elapsed": elapsed,
+        "mb_per_s": summary["bytes"] / elapsed / 1e6 if elapsed > 0 else 0.0,
+        "p50_ms": latency["p50"] * 1e3,
+        "p95_ms": latency["p95"] * 1e3,
+        "p99_ms": latency["p99"] * 1e3,
+        "max_ms": latency["max"] * 1e3,
+        "retries": summary.get("retries"),
+    }
+
+
+def print_result(result):
+    retries = "-" if result["retries"] is None else result["retries"]
+    print(
+        f"{result['engine']:>8}: {result['files'] - result['failed']}/{result['files']} files, "
+        f"{result['bytes'] / 1e6:.1f} MB in {result['elapsed']:.2f}s ({result['mb_per_s']:.1f} MB/s), "
+        f"p50 {result['p50_ms']:.0f} ms, p95 {result['p95_ms']:.0f} ms, "
+        f"p99 {result['p99_ms']:.0f} ms, {retries} retries"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the downloaders against a local stand-in")
+    parser.add_argument(
+        "--engine", choices=ENGINES + ("both",), default="both", help="engine(s) to run (default: both)"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="parallel downloads (default: 8)")
+    parser.add_argument("--per-host", type=int, default=8, help="parallel requests per host (default: 8)")
+    parser.add_argument("--timeout", type=float, default=2.0, help="per-operation timeout (default: 2)")
+    parser.add_argument("--retries", type=int, default=3, help="retries per file, async only (default: 3)")
+    parser.add_argument("--deadline", type=float, help="overall deadline in seconds, async only")
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in latency (default: 0.05)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="stand-in jitter (default: 0.05)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="stand-in failure rate")
+    parser.add_argument(
+        "--failures",
+        type=fixture_server.parse_failures,
+        default=fixture_server.FAILURE_MODES,
+        help="stand-in failure modes (default: all)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="stand-in random seed")
+    parser.add_argument("--output", default="bench_downloads.json", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    host, port = "127.0.0.1", free_port()
+    command = [
+        sys.executable,
+        fixture_server.__file__,
+        "--port", str(port),
+        "--bind", host,
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--failure-rate", str(args.failure_rate),
+        "--failures", ",".join(args.failures),
+        # Stalls outlast the client timeout so they exercise it
+        "--stall", str(args.timeout * 3),
+        "--seed", str(args.seed),
+    ]  # fmt: skip
+    # Injected failures make the stand-in log broken pipes; keep them out of the report
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    runs = []
+    try:
+        wait_for_port(host, port)
+        base_url = f"http://{host}:{port}"
+        for engine in ENGINES if args.engine == "both" else (args.engine,):
+            result = run_engine(engine, args, base_url)
+            runs.append(result)
+            print_result(result)
+    finally:
+        process.terminate()
+        process.wait()
+
+    report = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "failure_rate": args.failure_rate,
+        "failures": list(args.failures),
+        "workers": args.workers,
+        "timeout": args.timeout,
+        "python": platform.python_version(),
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+"""
+Benchmark suite for the image-processing hot paths.
+
+Runs the frame detection pipeline stage by stage (decode, HSV, inRange,
+morphology, Sobel, projection, peak finding, contours, crop, encode), plus
+find_frame_bounds (also with a pooled FrameMaskEngine and in low-memory strip
+mode) and image-analyzer's
+analyze_image end to end, on the checked-in classes/ and subclasses/ images
+and on synthetic upscaled copies. Records the best-of-N time per stage and the
+peak RSS and traced allocations per image, in the default and the low-memory
+mode, grouped by image set.
+
+--save-baseline stores the results as JSON; later runs compare against that
+baseline and exit non-zero when a stage is slower (or an image set uses more
+memory) than the baseline by more than --threshold.
+"""
+import io
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import tempfile
+import importlib
+import contextlib
+import tracemalloc
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import process_images
+
+analyzer = importlib.import_module("image-analyzer")
+
+
+BASELINE_PATH = "bench_images_baseline.json"
+
+STAGES = [
+    "decode",
+    "hsv",
+    "in_range",
+    "morphology",
+    "sobel",
+    "projection",
+    "peaks",
+    "contours",
+    "crop",
+    "encode",
+    "find_frame_bounds",
+    "find_frame_bounds_smooth",
+    "find_frame_bounds_pooled",
+    "find_frame_bounds_strips",
+    "analyze_image",
+    "analyze_image_reduced",
+]
+
+# Per-group stage totals under this many seconds are too noisy to gate on
+MIN_GATED_SECONDS = 0.02
+
+
+def read_peak_rss():
+    """Peak resident set size in bytes since the last reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS, and cannot be reset
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak-RSS counter where supported (Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return read_peak_rss()
+
+
+def timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    timings[stage] = min(timings.get(stage, elapsed), elapsed)
+    return result
+
+
+def run_stages(image_path, is_class, timings):
+    """One pass over the pipeline, stage by stage, as find_frame_bounds and process_image run it."""
+    img = timed(timings, "decode", process_images.load_image, image_path)
+    lower, upper = process_images.frame_hsv_range()
+    hsv = timed(timings, "hsv", cv2.cvtColor, img[:, :, :3], cv2.COLOR_BGR2HSV)
+
+    def in_range():
+        color_mask = cv2.inRange(hsv, lower, upper)
+        alpha_mask = (img[:, :, 3] > 127).astype(np.uint8)
+        return cv2.bitwise_and(color_mask, color_mask, mask=alpha_mask)
+
+    color_mask = timed(timings, "in_range", in_range)
+    kernel = np.ones((3, 3), np.uint8)
+    frame_mask = timed(
+        timings, "morphology", cv2.morphologyEx, color_mask, cv2.MORPH_CLOSE, kernel
+    )
+
+    def sobel():
+        return (
+            cv2.Sobel(frame_mask, cv2.CV_16S, 0, 1, ksize=3),
+            cv2.Sobel(frame_mask, cv2.CV_16S, 1, 0, ksize=3),
+        )
+
+    sobel_h, sobel_v = timed(timings, "sobel", sobel)
+
+    def projection():
+        return (
+            np.sum(np.abs(sobel_h), axis=1, dtype=np.int64),
+            np.sum(np.abs(sobel_v), axis=0, dtype=np.int64),
+        )
+
+    h_projection, v_projection = timed(timings, "projection", projection)
+    height, width = img.shape[:2]
+    bounds = timed(
+        timings,
+        "peaks",
+        process_images.bounds_from_projections,
+        h_projection,
+        v_projection,
+        width,
+        height,
+        is_class,
+        image_path,
+    )
+    timed(timings, "contours", process_images.smooth_to_rectangle, frame_mask)
+    clipped = timed(timings, "crop", process_images.crop_to_bounds, img, bounds)
+    timed(timings, "encode", cv2.imencode, ".png", clipped)
+
+    # Guard against the staged copy drifting from the real pipeline
+    if not np.array_equal(frame_mask, process_images.build_frame_mask(img)):
+        raise RuntimeError(f"Staged frame mask differs from build_frame_mask for {image_path}")
+
+
+def find_frame_bounds_pooled(image_path, is_class):
+    img = process_images.load_image(image_path)
+    return process_images.find_frame_bounds_in_array(
+        img, is_class, source=image_path, engine=process_images.shared_engine()
+    )
+
+
+def find_frame_bounds_strips(image_path, is_class, pixel_cache):
+    with process_images.load_mapped_pixels(image_path, pixel_cache) as mapped:
+        return process_images.find_frame_bounds_in_array(
+            mapped.pixels,
+            is_class,
+            source=image_path,
+            strip_rows=process_images.STRIP_ROWS,
+            release=mapped.release,
+        )
+
+
+def run_end_to_end(image_path, is_class, timings, pixel_cache):
+    timed(timings, "find_frame_bounds", process_images.find_frame_bounds, image_path, is_class)
+    timed(timings, "find_frame_bounds_pooled", find_frame_bounds_pooled, image_path, is_class)
+    # The pixel cache was filled before timing, so this maps instead of decoding
+    timed(
+        timings,
+        "find_frame_bounds_strips",
+        find_frame_bounds_strips,
+        image_path,
+        is_class,
+        pixel_cache,
+    )
+    timed(
+        timings,
+        "find_frame_bounds_smooth",
+        process_images.find_frame_bounds,
+        image_path,
+        is_class,
+        True,
+    )
+    # analyze_image prints one line per call
+    with contextlib.redirect_stdout(io.StringIO()):
+        timed(timings, "analyze_image", analyzer.analyze_image, Path(image_path))
+        timed(timings, "analyze_image_reduced", analyzer.analyze_image, Path(image_path), 2)
+
+
+def measure_memory(image_path, is_class, pixel_cache=None):
+    """
+    Peak RSS growth and peak traced allocation of one find_frame_bounds + crop +
+    encode; with pixel_cache, of the low-memory mode over pixels mapped from
+    that (already filled) cache. Run it in a fresh process: memory freed by
+    earlier images would otherwise be reused and hide the growth.
+    """
+    resettable = reset_peak_rss()
+    baseline = current_rss()
+    tracemalloc.start()
+    try:
+        if pixel_cache:
+            with process_images.load_mapped_pixels(image_path, pixel_cache) as mapped:
+                img = mapped.pixels
+                bounds = process_images.find_frame_bounds_in_array(
+                    img,
+                    is_class,
+                    source=image_path,
+                    strip_rows=process_images.STRIP_ROWS,
+                    release=mapped.release,
+                )
+                cv2.imencode(".png", process_images.crop_to_bounds(img, bounds))
+                del img
+        else:
+            img = process_images.load_image(image_path)
+            bounds = process_images.find_frame_bounds_in_array(img, is_class, source=image_path)
+            cv2.imencode(".png", process_images.crop_to_bounds(img, bounds))
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    peak_rss = max(0, read_peak_rss() - baseline) if resettable else None
+    return peak_rss, traced_peak
+
+
+def measure_memory_isolated(image_path, is_class, pixel_cache=None):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(measure_memory, image_path, is_class, pixel_cache).result()
+
+
+def make_upscaled(image_paths, factor, directory):
+    """Nearest-neighbour upscaled PNG copies (nearest keeps the exact frame colour)."""
+    paths = []
+    for image_path in image_paths:
+        img = process_images.load_image(image_path)
+        upscaled = cv2.resize(img, None, fx=factor, fy=factor, interpolation=cv2.INTER_NEAREST)
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        path = os.path.join(directory, f"{name}-x{factor}.png")
+        cv2.imwrite(path, upscaled)
+        paths.append(path)
+    return paths
+
+
+def bench_group(image_paths, is_class, repeat, pixel_cache):
+    stages = {stage: 0.0 for stage in STAGES}
+    peak_rss = []
+    traced = []
+    low_memory_rss = []
+    low_memory_traced = []
+    pixels = 0
+    for image_path in image_paths:
+        timings = {}
+        try:
+            process_images.load_mapped_pixels(image_path, pixel_cache).close()
+            for _ in range(repeat):
+                run_stages(image_path, is_class, timings)
+                run_end_to_end(image_path, is_class, timings, pixel_cache)
+            rss, traced_peak = measure_memory_isolated(image_path, is_class)
+            low_rss, low_traced = measure_memory_isolated(image_path, is_class, pixel_cache)
+        except ValueError as e:
+            print(f"Skipping {image_path}: {e}")
+            continue
+        for stage, elapsed in timings.items():
+            stages[stage] += elapsed
+        if rss is not None:
+            peak_rss.append(rss)
+            low_memory_rss.append(low_rss)
+        traced.append(traced_peak)
+        low_memory_traced.append(low_traced)
+        with open(image_path, "rb") as f:
+            header = f.read(24)
+        # IHDR width/height without decoding again
+        pixels += int.from_bytes(header[16:20], "big") * int.from_bytes(header[20:24], "big")
+    return {
+        "images": len(traced),
+        "megapixels": pixels / 1e6,
+        "stages": stages,
+        "peak_rss_mb": max(peak_rss) / 1e6 if peak_rss else None,
+        "traced_peak_mb": max(traced) / 1e6 if traced else None,
+        "low_memory_peak_rss_mb": max(low_memory_rss) / 1e6 if low_memory_rss else None,
+        "low_memory_traced_peak_mb": max(low_memory_traced) / 1e6 if low_memory_traced else None,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return a list of regression messages against a stored baseline."""
+    regressions = []
+    for group, result in results["groups"].items():
+        old = baseline["groups"].get(group)
+        if old is None or old["images"] != result["images"]:
+            print(f"  {group}: no comparable baseline")
+            continue
+        for stage, elapsed in result["stages"].items():
+            old_elapsed = old["stages"].get(stage)
+            if not old_elapsed or old_elapsed < MIN_GATED_SECONDS:
+                continue
+            change = elapsed / old_elapsed - 1
+            if change > threshold:
+                regressions.append(
+                    f"{group}/{stage}: {old_elapsed * 1e3:.1f} ms -> {elapsed * 1e3:.1f} ms "
+                    f"({change:+.0%})"
+                )
+        for key in (
+            "peak_rss_mb",
+            "traced_peak_mb",
+            "low_memory_peak_rss_mb",
+            "low_memory_traced_peak_mb",
+        ):
+            if result[key] and old.get(key) and result[key] / old[key] - 1 > threshold:
+                regressions.append(f"{group}/{key}: {old[key]:.1f} MB -> {result[key]:.1f} MB")
+    return regressions
+
+
+def print_group(group, result):
+    print(
+        f"{group}: {result['images']} images, {result['megapixels']:.1f} MP, "
+        f"peak RSS {result['peak_rss_mb'] or 0:.0f} MB, traced peak {result['traced_peak_mb'] or 0:.0f} MB; "
+        f"low-memory peak RSS {result['low_memory_peak_rss_mb'] or 0:.0f} MB, "
+        f"traced peak {result['low_memory_traced_peak_mb'] or 0:.0f} MB"
+    )
+    for stage, elapsed in result["stages"].items():
+        per_mp = elapsed / result["megapixels"] * 1e3 if result["megapixels"] else 0.0
+        print(f"  {stage:<26} {elapsed * 1e3:9.1f} ms  ({per_mp:6.2f} ms/MP)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image-processing hot paths")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per image, best is kept (default: 3)")
+    parser.add_argument("--limit", type=int, help="only the first N images of each folder")
+    parser.add_argument(
+        "--upscale", type=int, default=2, help="factor for the synthetic upscaled set (default: 2)"
+    )
+    parser.add_argument(
+        "--upscale-count",
+        type=int,
+        default=3,
+        help="images (class first) to include in the upscaled set, 0 to skip (default: 3)",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH, help=f"baseline JSON (default: {BASELINE_PATH})")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown/memory growth before failing, as a fraction (default: 0.25)",
+    )
+    parser.add_argument("--output", help="also write these results to a JSON file")
+    args = parser.parse_args()
+
+    sets = {
+        "classes": (sorted(glob.glob(os.path.join("classes", "*.png")))[: args.limit], True),
+        "subclasses": (sorted(glob.glob(os.path.join("subclasses", "*.png")))[: args.limit], False),
+    }
+
+    results = {
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "groups": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        if args.upscale_count > 0:
+            sources = (sets["classes"][0] + sets["subclasses"][0])[: args.upscale_count]
+            upscaled = make_upscaled(sources, args.upscale, directory)
+            # The upscaled set mixes classes and subclasses; detection treats them as subclasses
+            sets[f"upscaled_x{args.upscale}"] = (upscaled, False)
+
+        for group, (image_paths, is_class) in sets.items():
+            if not image_paths:
+                continue
+            pixel_cache = os.path.join(directory, "pixels")
+            result = bench_group(image_paths, is_class, args.repeat, pixel_cache)
+            results["groups"][group] = result
+            print_group(group, result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    print(f"Comparing against {args.baseline} (threshold {args.threshold:.0%})")
+    regressions = compare(results, baseline, args.threshold)
+    for message in regressions:
+        print(f"  REGRESSION {message}")
+    if regressions:
+        return 1
+    print("  No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Micro-benchmark for process_images.find_significant_peaks.
+
+Builds the h/v projections of the checked-in classes/ and subclasses/ images,
+checks the vectorized implementation returns the same peaks as the original
+loop-based one, and times both on projections of typical and 4x length. Seeded
+plateau and tie-heavy projections are checked too, since equal cluster scores
+are where the two can disagree.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import warnings
+import numpy as np
+
+import process_images
+
+
+def find_significant_peaks_loop(projection, min_height):
+    """The original loop-based implementation, kept as the reference."""
+    if np.max(projection) > 0:
+        normalized = projection / np.max(projection)
+    else:
+        return []
+
+    window_size = 5
+    smoothed = np.convolve(normalized, np.ones(window_size) / window_size, mode="same")
+
+    all_peaks = []
+    small_threshold = 0.1
+    for i in range(1, len(smoothed) - 1):
+        if (
+            smoothed[i] > small_threshold
+            and smoothed[i] > smoothed[i - 1]
+            and smoothed[i] > smoothed[i + 1]
+        ):
+            all_peaks.append((i, smoothed[i]))
+
+    if not all_peaks:
+        return []
+
+    clusters = []
+    min_dist = max(10, int(len(projection) * 0.01))
+    max_dist = max(20, int(len(projection) * 0.03))
+    current_cluster = [all_peaks[0]]
+    grad_scores = np.gradient(smoothed)
+
+    for i in range(1, len(all_peaks)):
+        current_peak = all_peaks[i]
+        last_peak = all_peaks[i - 1]
+        peak_distance = current_peak[0] - last_peak[0]
+        region_start = max(0, last_peak[0])
+        region_end = min(len(grad_scores), current_peak[0])
+        grad_continuity = np.mean(np.abs(grad_scores[region_start:region_end]))
+        if peak_distance < max_dist and (peak_distance < min_dist or grad_continuity > 0.1):
+            current_cluster.append(current_peak)
+        else:
+            if len(current_cluster) > 0:
+                cluster_score = sum(p[1] for p in current_cluster) * (1 + grad_continuity)
+                clusters.append((current_cluster, cluster_score))
+            current_cluster = [current_peak]
+
+    if current_cluster:
+        region_start = max(0, current_cluster[0][0])
+        region_end = min(len(grad_scores), current_cluster[-1][0])
+        with warnings.catch_warnings():
+            # A single-peak cluster averages an empty slice (NaN score)
+            warnings.simplefilter("ignore", RuntimeWarning)
+            grad_continuity = np.mean(np.abs(grad_scores[region_start:region_end]))
+        cluster_score = sum(p[1] for p in current_cluster) * (1 + grad_continuity)
+        clusters.append((current_cluster, cluster_score))
+
+    clusters.sort(key=lambda x: x[1], reverse=True)
+    scored_clusters = []
+    for cluster, score in clusters:
+        weights = [p[1] for p in cluster]
+        positions = [p[0] for p in cluster]
+        avg_pos = int(np.average(positions, weights=weights))
+        spread = np.std(positions)
+        if spread < max_dist:
+            scored_clusters.append((avg_pos, score))
+
+    scored_clusters.sort(key=lambda x: x[1], reverse=True)
+    peak_positions = [pos for pos, _ in scored_clusters[:4]]
+
+    if len(peak_positions) >= 2:
+        return sorted(peak_positions)
+    else:
+        strong_peaks = []
+        for i in range(1, len(smoothed) - 1):
+            if (
+                smoothed[i] > 0.5
+                and smoothed[i] > smoothed[i - 1]
+                and smoothed[i] > smoothed[i + 1]
+            ):
+                strong_peaks.append(i)
+        return strong_peaks
+
+
+def frame_projections(image_path):
+    """The h/v projections find_frame_bounds feeds to the peak finder."""
+    img = process_images.load_image(image_path)
+    return process_images.edge_projections(process_images.build_frame_mask(img))
+
+
+def stretch(projection, factor):
+    """Linearly resample a projection to factor times its length."""
+    x = np.linspace(0, len(projection) - 1, len(projection) * factor)
+    return np.interp(x, np.arange(len(projection)), projection)
+
+
+def plateau_projections(count=600, seed=0):
+    """Projections with many equal values: small integers, runs of steps and a few noise ones."""
+    rng = np.random.default_rng(seed)
+    projections = []
+    for i in range(count):
+        length = int(rng.integers(50, 800))
+        if i % 3 == 0:
+            projection = rng.integers(0, 4, length)
+        elif i % 3 == 1:
+            projection = np.repeat(rng.integers(0, 6, length // 8 + 1), 8)[:length]
+        else:
+            projection = rng.random(length)
+        projections.append(projection.astype(float))
+    return projections
+
+
+def check(projections, label):
+    """Compare both implementations, printing each mismatch. Returns the count."""
+    mismatches = 0
+    with warnings.catch_warnings():
+        # All-equal and single-peak inputs average empty slices in the loop version
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for projection in projections:
+            expected = find_significant_peaks_loop(projection, 0)
+            actual = process_images.find_significant_peaks(projection, 0)
+            if list(expected) != list(actual):
+                mismatches += 1
+                print(f"Mismatch ({label}, length {len(projection)}): {expected} != {actual}")
+    return mismatches
+
+
+def time_function(func, projections, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for projection in projections:
+            func(projection, 0)
+    return (time.perf_counter() - start) / (repeat * len(projections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions (default: 5)")
+    args = parser.parse_args()
+
+    image_paths = sorted(glob.glob(os.path.join("classes", "*.png"))) + sorted(
+        glob.glob(os.path.join("subclasses", "*.png"))
+    )
+    projections = []
+    for image_path in image_paths:
+        try:
+            projections.extend(frame_projections(image_path))
+        except ValueError as e:
+            print(f"Skipping {image_path}: {e}")
+    if not projections:
+        print("No projections to benchmark")
+        return 1
+
+    plateaus = plateau_projections()
+    mismatches = check(plateaus, "plateau")
+    print(f"Checked {len(plateaus)} plateau projections, {mismatches} mismatches")
+
+    for factor in (1, 4):
+        variants = [stretch(p, factor) for p in projections] if factor > 1 else projections
+        mismatches += check(variants, f"{factor}x")
+
+        loop_time = time_function(find_significant_peaks_loop, variants, args.repeat)
+        vector_time = time_function(process_images.find_significant_peaks, variants, args.repeat)
+        mean_length = int(np.mean([len(p) for p in variants]))
+        print(
+            f"{factor}x length (mean {mean_length}): loop {loop_time * 1e3:.3f} ms, "
+            f"vectorized {vector_time * 1e3:.3f} ms, speedup {loop_time / vector_time:.1f}x"
+        )
+
+    print(f"Checked {len(projections) * 2 + len(plateaus)} projections, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
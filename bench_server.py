@@ -0,0 +1,242 @@
+"""
+Load benchmark for server.py.
+
+Starts server.py on a local port (or targets --url), then has N concurrent
+clients replay page loads over keep-alive connections: index.html, style.css,
+script.js, image-offsets.json, 12 class PNGs and 48 subclass PNGs. Reports
+requests/s, bytes/s and p50/p95/p99 latency per request and per page load,
+and writes the results as JSON so server modes can be compared between runs.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlparse, quote
+
+import server
+from downloader import percentile
+
+
+PAGE_ASSETS = ["/", "/style.css", "/script.js", "/image-offsets.json"]
+CLASS_IMAGES = 12
+SUBCLASS_IMAGES = 48
+
+BROWSER_ACCEPT_ENCODING = "gzip, deflate, br"
+
+
+def image_paths(folder, count):
+    """count images from folder, cycling through them if the folder has fewer."""
+    files = sorted(f for f in os.listdir(folder) if f.endswith(".png"))
+    if not files:
+        raise SystemExit(f"No PNG files in {folder}/")
+    if len(files) < count:
+        print(f"Only {len(files)} images in {folder}/, repeating them to make {count}")
+    return [f"/{folder}/{quote(files[i % len(files)])}" for i in range(count)]
+
+
+def page_load_mix():
+    return (
+        PAGE_ASSETS
+        + image_paths("classes", CLASS_IMAGES)
+        + image_paths("subclasses", SUBCLASS_IMAGES)
+    )
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {
+        "p50_ms": percentile(values, 50) * 1e3,
+        "p95_ms": percentile(values, 95) * 1e3,
+        "p99_ms": percentile(values, 99) * 1e3,
+        "max_ms": (values[-1] if values else 0.0) * 1e3,
+    }
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"Server did not start listening on {host}:{port}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client(threading.Thread):
+    """One keep-alive connection replaying page loads until the deadline."""
+
+    def __init__(self, host, port, paths, deadline, accept_encoding):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.paths = paths
+        self.deadline = deadline
+        self.headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+        self.latencies = []
+        self.page_latencies = []
+        self.bytes = 0
+        self.errors = 0
+
+    def run(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            while time.perf_counter() < self.deadline:
+                page_start = time.perf_counter()
+                for path in self.paths:
+                    start = time.perf_counter()
+                    try:
+                        connection.request("GET", path, headers=self.headers)
+                        response = connection.getresponse()
+                        body = response.read()
+                    except (OSError, http.client.HTTPException):
+                        self.errors += 1
+                        connection.close()
+                        continue
+                    self.latencies.append(time.perf_counter() - start)
+                    self.bytes += len(body)
+                    if response.status != 200:
+                        self.errors += 1
+                # Only complete page loads count towards the page latency
+                if time.perf_counter() < self.deadline:
+                    self.page_latencies.append(time.perf_counter() - page_start)
+        finally:
+            connection.close()
+
+
+def run_load(host, port, paths, concurrency, duration, accept_encoding):
+    start = time.perf_counter()
+    deadline = start + duration
+    clients = [
+        # Each client starts at a different point of the page so requests interleave
+        Client(host, port, paths[i % len(paths) :] + paths[: i % len(paths)], deadline, accept_encoding)
+        for i in range(concurrency)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [value for client in clients for value in client.latencies]
+    page_latencies = [value for client in clients for value in client.page_latencies]
+    total_bytes = sum(client.bytes for client in clients)
+    return {
+        "requests": len(latencies),
+        "errors": sum(client.errors for client in clients),
+        "page_loads": len(page_latencies),
+        "bytes": total_bytes,
+        "elapsed": elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "bytes_per_s": total_bytes / elapsed,
+        "latency": latency_summary(latencies),
+        "page_latency": latency_summary(page_latencies),
+    }
+
+
+def print_result(concurrency, result, baseline=None):
+    latency = result["latency"]
+    line = (
+        f"c={concurrency:<4} {result['requests_per_s']:8.0f} req/s "
+        f"{result['bytes_per_s'] / 1e6:8.1f} MB/s  "
+        f"p50 {latency['p50_ms']:7.2f} ms  p95 {latency['p95_ms']:7.2f} ms  "
+        f"p99 {latency['p99_ms']:7.2f} ms  page p50 {result['page_latency']['p50_ms']:8.1f} ms"
+    )
+    if result["errors"]:
+        line += f"  {result['errors']} errors"
+    if baseline:
+        change = result["requests_per_s"] / baseline["requests_per_s"] - 1
+        line += f"  ({change:+.0%} req/s vs baseline)"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for server.py")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32],
+        help="concurrent clients, one run per value (default: 1 8 32)",
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run (default: 10)")
+    parser.add_argument("--warmup", type=float, default=1.0, help="warm-up seconds before each run")
+    parser.add_argument(
+        "--server-args",
+        default="",
+        help='extra arguments for server.py, e.g. "--no-sendfile --hot-cache-mb 0"',
+    )
+    parser.add_argument("--url", help="benchmark an already running server instead")
+    parser.add_argument(
+        "--accept-encoding",
+        default=BROWSER_ACCEPT_ENCODING,
+        help=f'Accept-Encoding to send, "" for none (default: "{BROWSER_ACCEPT_ENCODING}")',
+    )
+    parser.add_argument("--label", help="name for this run in the JSON (default: the server args)")
+    parser.add_argument("--output", default="bench_server.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier JSON results to compare requests/s against")
+    args = parser.parse_args()
+
+    paths = page_load_mix()
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = {run["concurrency"]: run for run in json.load(f)["runs"]}
+
+    process = None
+    if args.url:
+        parsed = urlparse(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        host, port = "127.0.0.1", free_port()
+        command = [sys.executable, server.__file__, "--port", str(port), "--bind", host, "--quiet"]
+        command += args.server_args.split()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(host, port)
+        print(f"Benchmarking {host}:{port}, {len(paths)} requests per page load")
+        runs = []
+        for concurrency in args.concurrency:
+            if args.warmup > 0:
+                run_load(host, port, paths, concurrency, args.warmup, args.accept_encoding)
+            result = run_load(host, port, paths, concurrency, args.duration, args.accept_encoding)
+            result["concurrency"] = concurrency
+            runs.append(result)
+            print_result(concurrency, result, baseline.get(concurrency))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "label": args.label or args.url or (args.server_args or "default"),
+        "server_args": args.server_args,
+        "url": args.url,
+        "accept_encoding": args.accept_encoding,
+        "duration": args.duration,
+        "requests_per_page": len(paths),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    return 1 if any(run["errors"] for run in runs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
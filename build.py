@@ -0,0 +1,350 @@
+"""
+Single build command for the site's image data.
+
+Runs the stages that used to be separate scripts as one dependency graph:
+
+    download -> decode -> size   -> aspect_ratios.txt
+                       -> bounds -> crop (processed/*_clipped.png)
+                                 -> image_bounds.json
+                       -> offset -> image-offsets.json   (subclasses only)
+
+Each image is decoded once, and the BGRA pixels are shared by the size,
+bounds, offset and crop stages. Images run in parallel on a process pool.
+Stage results are cached by content hash and parameters, in the same caches
+process_images.py and image-analyzer.py use. A stage reruns only when its
+cache misses or a stage it depends on reruns, and an image is decoded only
+when one of its stages has to run. The site outputs are rewritten only when
+their contents change.
+"""
+import os
+import json
+import time
+import argparse
+import importlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+import instrument
+import process_images
+from result_cache import CACHE_DIR, ResultCache, file_digest
+
+analyzer = importlib.import_module("image-analyzer")
+
+
+# Per-image stages and the stages they depend on, in topological order
+IMAGE_STAGES = {
+    "decode": (),
+    "size": ("decode",),
+    "bounds": ("decode",),
+    "offset": ("decode",),
+    "crop": ("decode", "bounds"),
+}
+
+URL_FILES = (("urls_classes.txt", "classes"), ("urls.txt", "subclasses"))
+
+SIZE_VERSION = 1
+
+
+def stages_for(is_class):
+    """The per-image stages that apply to an image (offsets are only used for subclasses)."""
+    return [stage for stage in IMAGE_STAGES if not (is_class and stage == "offset")]
+
+
+def plan_stages(stages, fresh):
+    """
+    Stages that have to run for one image: those whose result is not fresh,
+    plus everything downstream of them, plus decode if any of those needs pixels.
+    """
+    stale = []
+    for stage in stages:
+        if stage == "decode":
+            continue
+        if not fresh.get(stage) or any(dep in stale for dep in IMAGE_STAGES[stage]):
+            stale.append(stage)
+    if any("decode" in IMAGE_STAGES[stage] for stage in stale):
+        stale.insert(0, "decode")
+    return stale
+
+
+def run_stage(stage, img, image_path, is_class, results, params):
+    if stage == "decode":
+        return process_images.load_image(image_path)
+    if stage == "size":
+        results["size"] = [int(img.shape[1]), int(img.shape[0])]
+    elif stage == "bounds":
+        results["bounds"] = process_images.find_frame_bounds_in_array(
+            img,
+            is_class,
+            params["smooth_contours"],
+            source=image_path,
+            coarse_scale=params["coarse_scale"],
+            engine=process_images.shared_engine(),
+        )
+    elif stage == "offset":
+        results["offset"] = analyzer.offset_from_pixels(img, image_path)
+    elif stage == "crop":
+        output_path = process_images.clipped_path(image_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        clipped = process_images.crop_to_bounds(img, results["bounds"])
+        if not cv2.imwrite(output_path, clipped):
+            raise ValueError(f"Could not write clipped image for {image_path}")
+    return img
+
+
+def run_image(job):
+    """
+    Run the planned stages of one image. job is (image_path, is_class, stale
+    stages, cached results, params). Returns the results, the time of every
+    stage that ran and the stages that failed; stages depending on a failed
+    one are skipped.
+    """
+    image_path, is_class, stale, results, params = job
+    results = dict(results)
+    timings = {}
+    failed = []
+    img = None
+    with instrument.span("build_image", image=image_path):
+        for stage in stale:
+            if any(dep in failed for dep in IMAGE_STAGES[stage]):
+                failed.append(stage)
+                continue
+            start = time.perf_counter()
+            try:
+                with instrument.span(stage):
+                    img = run_stage(stage, img, image_path, is_class, results, params)
+            except Exception as e:
+                print(f"Error in {stage} for {image_path}: {e}")
+                failed.append(stage)
+                continue
+            timings[stage] = time.perf_counter() - start
+    return {"results": results, "timings": timings, "failed": failed}
+
+
+def write_if_changed(path, text):
+    """Atomically replace path with text unless it already holds exactly that."""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == text:
+                return False
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return True
+
+
+def format_aspect_ratios(sizes):
+    """The aspect_ratios.txt format of test.print_image_aspect_ratios."""
+    lines = []
+    for folder, images in sizes.items():
+        lines.append(f"Directory: {folder}")
+        for image_file, (width, height) in images.items():
+            ratio = width / height if height != 0 else 0
+            lines.append(f"{image_file}: {ratio:.2f}")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def image_digest(image_path, memo):
+    """file_digest, remembered per (mtime, size) so unchanged files are not hashed again."""
+    st = os.stat(image_path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = memo.get(image_path)
+    if entry is None or entry[0] != stamp:
+        entry = memo[image_path] = (stamp, file_digest(image_path))
+    return entry[1]
+
+
+def download_sources(use_async=False):
+    import test
+
+    with instrument.span("download"), test.make_downloader(use_async) as downloader:
+        for url_file, folder in URL_FILES:
+            if os.path.exists(url_file):
+                test.process_file(url_file, folder, downloader)
+            else:
+                print(f"Skipping download for {folder}: {url_file} not found")
+
+
+def build(
+    jobs=1,
+    smooth_contours=True,
+    coarse_scale=1,
+    force=False,
+    download=False,
+    digests=None,
+    async_download=False,
+):
+    """
+    Bring every output up to date. digests, a dict kept between calls (as
+    watch.py does), lets repeated builds skip hashing files that have not changed.
+    async_download downloads with async_fetch.AsyncDownloader instead of Downloader.
+    """
+    start = time.perf_counter()
+    if download:
+        download_sources(async_download)
+
+    params = {"smooth_contours": smooth_contours, "coarse_scale": coarse_scale}
+    caches = {
+        "size": ResultCache(os.path.join(CACHE_DIR, "image_sizes.json"), SIZE_VERSION),
+        "bounds": ResultCache(
+            os.path.join(CACHE_DIR, "frame_bounds.json"), process_images.FRAME_BOUNDS_VERSION
+        ),
+        "offset": ResultCache(
+            os.path.join(CACHE_DIR, "image_offsets.json"), analyzer.OFFSET_VERSION
+        ),
+    }
+
+    crops = process_images.open_crop_record()
+
+    tasks = process_images.list_image_tasks()
+    plans = []
+    for folder, image_file, is_class in tasks:
+        image_path = os.path.join(folder, image_file)
+        if digests is not None:
+            digest = image_digest(image_path, digests)
+        else:
+            digest = file_digest(image_path)
+        keys = {
+            "size": caches["size"].key(digest, {}),
+            "bounds": caches["bounds"].key(
+                digest, process_images.frame_bounds_params(is_class, smooth_contours, coarse_scale)
+            ),
+            # Same key as image-analyzer's full-resolution path
+            "offset": caches["offset"].key(
+                digest, {"threshold": analyzer.THRESHOLD, "reduce": None}
+            ),
+        }
+        stages = stages_for(is_class)
+        cached = {}
+        for stage in stages:
+            if stage in caches and not force:
+                value = caches[stage].get(keys[stage])
+                if value is not None:
+                    cached[stage] = value
+        fresh = {stage: True for stage in cached}
+        # The crop is fresh only if it was cut from this content with these bounds
+        fresh["crop"] = (
+            not force
+            and "bounds" in cached
+            and process_images.crop_is_current(crops, image_path, digest, cached["bounds"])
+        )
+        stale = plan_stages(stages, fresh)
+        plans.append(
+            {
+                "folder": folder,
+                "image_file": image_file,
+                "digest": digest,
+                "keys": keys,
+                "stale": stale,
+                "results": cached,
+                "job": (image_path, is_class, stale, cached, params),
+            }
+        )
+
+    pending = [plan for plan in plans if plan["stale"]]
+    jobs_to_run = [plan["job"] for plan in pending]
+    if jobs > 1 and len(jobs_to_run) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=process_images.init_worker) as pool:
+            computed = list(pool.map(run_image, jobs_to_run, chunksize=1))
+    else:
+        computed = [run_image(job) for job in jobs_to_run]
+
+    stage_times = {}
+    decoded = 0
+    failed = 0
+    changed_offsets = set()
+    for plan, outcome in zip(pending, computed):
+        plan["results"] = outcome["results"]
+        failed += bool(outcome["failed"])
+        decoded += "decode" in outcome["timings"]
+        for stage, elapsed in outcome["timings"].items():
+            stage_times[stage] = stage_times.get(stage, 0.0) + elapsed
+            if stage in caches:
+                caches[stage].put(plan["keys"][stage], outcome["results"][stage])
+        if "offset" in outcome["timings"]:
+            changed_offsets.add(os.path.splitext(plan["image_file"])[0])
+        if "crop" in plan["stale"]:
+            crop_ok = "crop" in outcome["timings"] and "crop" not in outcome["failed"]
+            process_images.record_crop(
+                crops,
+                os.path.join(plan["folder"], plan["image_file"]),
+                plan["digest"],
+                outcome["results"].get("bounds") if crop_ok else None,
+            )
+
+    sizes = {}
+    bounds = {}
+    offsets = {}
+    for plan in plans:
+        folder, image_file, results = plan["folder"], plan["image_file"], plan["results"]
+        if results.get("size"):
+            sizes.setdefault(folder, {})[image_file] = results["size"]
+        if results.get("bounds"):
+            bounds.setdefault(folder, {})[image_file] = results["bounds"]
+        if results.get("offset") is not None:
+            offsets[os.path.splitext(image_file)[0]] = results["offset"]
+
+    for cache in caches.values():
+        cache.save()
+    crops.save()
+
+    written = []
+    with instrument.span("outputs"):
+        if write_if_changed("aspect_ratios.txt", format_aspect_ratios(sizes)):
+            written.append("aspect_ratios.txt")
+        if write_if_changed("image_bounds.json", json.dumps(bounds, indent=2) + "\n"):
+            written.append("image_bounds.json")
+        # Offsets are merged, so hand-tuned entries of images that did not change stay
+        # Entries of subclass images that no longer exist are dropped
+        sources = {
+            os.path.splitext(image_file)[0] for _, image_file, is_class in tasks if not is_class
+        }
+        if analyzer.merge_offsets(Path("image-offsets.json"), offsets, changed_offsets, sources):
+            written.append("image-offsets.json")
+
+    for stage, elapsed in stage_times.items():
+        print(f"  {stage:<8} {elapsed:7.2f}s")
+    print(
+        f"Built {len(tasks)} images in {time.perf_counter() - start:.2f}s with {jobs} job(s): "
+        f"{len(pending)} rebuilt ({decoded} decoded), {len(plans) - len(pending)} up to date, "
+        f"{failed} with failed stages; updated {', '.join(written) or 'no outputs'}"
+    )
+    return failed == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the site's image data in one pass")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1, help="worker processes (default: all cores)"
+    )
+    parser.add_argument("--download", action="store_true", help="download the source images first")
+    parser.add_argument(
+        "--async-download",
+        action="store_true",
+        help="with --download: use the asyncio engine (retries, deadline, byte cap)",
+    )
+    parser.add_argument("--force", action="store_true", help="rebuild every stage of every image")
+    parser.add_argument(
+        "--no-smooth", action="store_true", help="use the projection path instead of contours"
+    )
+    parser.add_argument(
+        "--coarse-scale",
+        type=int,
+        choices=process_images.COARSE_SCALES,
+        default=1,
+        help="pyramid level for the projection path",
+    )
+    args = parser.parse_args()
+    with instrument.profiled(), instrument.span("build"):
+        ok = build(
+            jobs=args.jobs,
+            smooth_contours=not args.no_smooth,
+            coarse_scale=args.coarse_scale,
+            force=args.force,
+            download=args.download,
+            async_download=args.async_download,
+        )
+    raise SystemExit(0 if ok else 1)
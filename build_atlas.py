@@ -0,0 +1,231 @@
+"""
+Pack class previews and class icons into sprite atlases.
+
+Class art is cropped tightly to its frame with process_images.find_frame_bounds
+when the detected frame has the expected proportions; otherwise detection
+missed part of the frame and the whole image is used, so no art is cut from
+the preview. Icons are cropped to their opaque area. Sprites are scaled down
+and each group is shelf-packed into one or a few atlas images under atlas/;
+atlas.json records where every sprite lives so the page can draw tiles from
+the atlas instead of fetching one file per image. A group is only repacked
+when one of its inputs or the settings change.
+"""
+import os
+import math
+import json
+import time
+import argparse
+
+import cv2
+from PIL import Image
+
+import process_images
+from result_cache import file_digest
+
+
+OUTPUT_DIR = "atlas"
+ATLAS_JSON = "atlas.json"
+
+# group name -> (source folder, sprite height in pixels, crop to frame)
+GROUPS = {
+    "classes": ("classes", 384, True),
+    "icons": ("icons", 150, False),
+}
+
+MAX_ATLAS_SIZE = 2048
+SPRITE_PADDING = 2
+WEBP_QUALITY = 90
+
+# Height / width of a class frame (the constants of bounds_from_projections).
+# A detected frame further than RATIO_TOLERANCE from it is a partial detection
+CLASS_FRAME_RATIO = 1.57 / 1.16
+RATIO_TOLERANCE = 0.1
+
+
+def frame_crop(img, image_path):
+    """Frame bounds of BGRA class art, or None when none fit the expected ratio."""
+    try:
+        bounds = process_images.find_frame_bounds_in_array(
+            img, is_class=True, smooth_contours=True, source=image_path
+        )
+    except ValueError as e:
+        print(f"{e}, using the whole image")
+        return None
+    ratio = bounds["height"] / bounds["width"] if bounds["width"] else 0.0
+    if abs(ratio / CLASS_FRAME_RATIO - 1) > RATIO_TOLERANCE:
+        print(f"Frame in {image_path} is {ratio:.2f} tall per wide, using the whole image")
+        return None
+    return bounds
+
+
+def load_sprite(image_path, sprite_height, frame):
+    """Decode, crop and scale one input. Returns (PIL RGBA image, crop bounds)."""
+    if frame:
+        img = process_images.load_image(image_path)
+        height, width = img.shape[:2]
+        bounds = frame_crop(img, image_path) or {"x": 0, "y": 0, "width": width, "height": height}
+        cropped = process_images.crop_to_bounds(img, bounds)
+        sprite = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGRA2RGBA), "RGBA")
+    else:
+        with Image.open(image_path) as img:
+            sprite = img.convert("RGBA")
+        # Opaque area: pixels with alpha > 127, or the whole image
+        box = sprite.getchannel("A").point(lambda a: 255 if a > 127 else 0).getbbox()
+        box = box or (0, 0, sprite.width, sprite.height)
+        bounds = {"x": box[0], "y": box[1], "width": box[2] - box[0], "height": box[3] - box[1]}
+        sprite = sprite.crop(box)
+    if sprite.height > sprite_height:
+        width = max(1, round(sprite.width * sprite_height / sprite.height))
+        sprite = sprite.resize((width, sprite_height), Image.LANCZOS, reducing_gap=3.0)
+    return sprite, bounds
+
+
+def shelf_pack(sizes, max_size=MAX_ATLAS_SIZE, padding=SPRITE_PADDING):
+    """
+    Pack (width, height) boxes into as few max_size atlases as needed, tallest
+    first, filling shelves left to right.
+    Returns per-box (atlas index, x, y) and the used (width, height) of each atlas.
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    placements = [None] * len(sizes)
+    atlases = []  # [used_width, used_height, shelf_y, shelf_height, cursor_x]
+
+    # Aim for roughly square atlases instead of one long shelf
+    area = sum((width + padding) * (height + padding) for width, height in sizes)
+    widest = max((width for width, _ in sizes), default=0)
+    shelf_width = min(max_size, max(widest, math.ceil(math.sqrt(area * 1.1))))
+
+    for i in order:
+        width, height = sizes[i]
+        if width > max_size or height > max_size:
+            raise ValueError(f"Sprite of {width}x{height} does not fit a {max_size} atlas")
+        for index, atlas in enumerate(atlases):
+            used_width, used_height, shelf_y, shelf_height, cursor_x = atlas
+            if cursor_x + width <= shelf_width and height <= shelf_height:
+                break
+            # Open a new shelf below the current one
+            if shelf_y + shelf_height + padding + height <= max_size:
+                shelf_y += shelf_height + padding
+                atlas[2], atlas[3], atlas[4] = shelf_y, height, 0
+                break
+        else:
+            atlases.append([0, 0, 0, height, 0])
+            index = len(atlases) - 1
+        atlas = atlases[index]
+        x, y = atlas[4], atlas[2]
+        placements[i] = (index, x, y)
+        atlas[4] = x + width + padding
+        atlas[0] = max(atlas[0], x + width)
+        atlas[1] = max(atlas[1], y + height)
+
+    return placements, [(atlas[0], atlas[1]) for atlas in atlases]
+
+
+def build_group(name, folder, sprite_height, frame):
+    paths = [
+        os.path.join(folder, image_file).replace(os.sep, "/")
+        for image_file in sorted(os.listdir(folder))
+        if image_file.endswith(".png")
+    ]
+    loaded = [load_sprite(path, sprite_height, frame) for path in paths]
+    placements, atlas_sizes = shelf_pack([sprite.size for sprite, _ in loaded])
+
+    canvases = [Image.new("RGBA", size, (0, 0, 0, 0)) for size in atlas_sizes]
+    sprites = {}
+    for path, (sprite, bounds), (index, x, y) in zip(paths, loaded, placements):
+        canvases[index].paste(sprite, (x, y))
+        sprites[path] = {
+            "atlas": index,
+            "x": x,
+            "y": y,
+            "width": sprite.width,
+            "height": sprite.height,
+            "source_bounds": bounds,
+        }
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    atlases = []
+    for index, canvas in enumerate(canvases):
+        path = f"{OUTPUT_DIR}/{name}-{index}.webp"
+        tmp_path = f"{path}.tmp"
+        canvas.save(tmp_path, "WEBP", quality=WEBP_QUALITY)
+        os.replace(tmp_path, path)
+        atlases.append({"src": path, "width": canvas.width, "height": canvas.height})
+    return atlases, sprites
+
+
+def build_all(force=False):
+    previous = {}
+    if os.path.exists(ATLAS_JSON):
+        with open(ATLAS_JSON, "r") as f:
+            previous = json.load(f)
+
+    start = time.perf_counter()
+    result = {}
+    for name, (folder, sprite_height, frame) in GROUPS.items():
+        if not os.path.exists(folder):
+            continue
+        inputs = {
+            os.path.join(folder, image_file).replace(os.sep, "/"): file_digest(
+                os.path.join(folder, image_file)
+            )
+            for image_file in sorted(os.listdir(folder))
+            if image_file.endswith(".png")
+        }
+        settings = {
+            "sprite_height": sprite_height,
+            "frame": frame,
+            "max_atlas_size": MAX_ATLAS_SIZE,
+            "padding": SPRITE_PADDING,
+            "webp_quality": WEBP_QUALITY,
+            "ratio_tolerance": RATIO_TOLERANCE,
+            "frame_bounds_version": process_images.FRAME_BOUNDS_VERSION,
+        }
+        old = previous.get(name)
+        if (
+            not force
+            and old
+            and old.get("inputs") == inputs
+            and old.get("settings") == settings
+            and all(os.path.exists(atlas["src"]) for atlas in old["atlases"])
+        ):
+            result[name] = old
+            print(f"Atlas group {name} unchanged")
+            continue
+
+        atlases, sprites = build_group(name, folder, sprite_height, frame)
+        result[name] = {
+            "atlases": atlases,
+            "sprites": sprites,
+            "inputs": inputs,
+            "settings": settings,
+        }
+        print(f"Packed {len(sprites)} {name} sprites into {len(atlases)} atlas(es)")
+
+    if result != previous:
+        tmp_path = f"{ATLAS_JSON}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(result, f, indent=2)
+        os.replace(tmp_path, ATLAS_JSON)
+    remove_stale_atlases(result)
+    print(f"Atlas build finished in {time.perf_counter() - start:.2f}s")
+    return result
+
+
+def remove_stale_atlases(result):
+    """Delete atlas images no group refers to, such as those of dropped groups."""
+    if not os.path.exists(OUTPUT_DIR):
+        return
+    wanted = {atlas["src"] for group in result.values() for atlas in group["atlases"]}
+    for image_file in os.listdir(OUTPUT_DIR):
+        path = f"{OUTPUT_DIR}/{image_file}"
+        if path not in wanted:
+            os.remove(path)
+            print(f"Removed stale atlas {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack class previews and icons into atlases")
+    parser.add_argument("--force", action="store_true", help="repack every group")
+    args = parser.parse_args()
+    build_all(force=args.force)
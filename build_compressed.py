@@ -0,0 +1,130 @@
+"""
+Write precompressed siblings of the site's text assets.
+
+For every html/css/js/json file at the top level, a .gz (and a .br when the
+brotli module is installed) is written next to it at maximum compression.
+server.py serves those to clients that accept them and never compresses on
+the fly. Siblings carry their source's mtime, which is how both this script
+and the server tell that one is stale. A sibling that would not be smaller
+than its source is not written.
+"""
+import os
+import glob
+import gzip
+import time
+import argparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+TEXT_ASSETS = ("*.html", "*.css", "*.js", "*.json")
+
+
+def compress_gzip(data):
+    # mtime=0 keeps the output byte-identical between builds
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compress_brotli(data):
+    return brotli.compress(data, quality=11)
+
+
+# file suffix -> compressor, in the order the server prefers them
+ENCODERS = {".br": compress_brotli, ".gz": compress_gzip}
+
+
+def available_encoders():
+    return {suffix: encode for suffix, encode in ENCODERS.items() if suffix != ".br" or brotli}
+
+
+def text_assets():
+    return sorted({path for pattern in TEXT_ASSETS for path in glob.glob(pattern)})
+
+
+def is_fresh(source_st, sibling_path):
+    try:
+        return os.stat(sibling_path).st_mtime_ns == source_st.st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def write_sibling(source_st, sibling_path, data):
+    tmp_path = f"{sibling_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.utime(tmp_path, ns=(source_st.st_atime_ns, source_st.st_mtime_ns))
+    os.replace(tmp_path, sibling_path)
+
+
+def build_asset(path, encoders, force=False):
+    """Compress one asset. Returns {suffix: compressed size or None if not worth it}."""
+    st = os.stat(path)
+    sizes = {}
+    data = None
+    for suffix, encode in encoders.items():
+        sibling_path = path + suffix
+        if not force and is_fresh(st, sibling_path):
+            sizes[suffix] = os.path.getsize(sibling_path)
+            continue
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        compressed = encode(data)
+        if len(compressed) < len(data):
+            write_sibling(st, sibling_path, compressed)
+            sizes[suffix] = len(compressed)
+        else:
+            if os.path.exists(sibling_path):
+                os.remove(sibling_path)
+            sizes[suffix] = None
+    return sizes
+
+
+def build_all(force=False):
+    encoders = available_encoders()
+    if brotli is None:
+        print("brotli module not installed, writing .gz siblings only")
+
+    start = time.perf_counter()
+    results = {}
+    for path in text_assets():
+        results[path] = (os.path.getsize(path), build_asset(path, encoders, force))
+    print_report(results, list(encoders), time.perf_counter() - start)
+    return results
+
+
+def print_report(results, suffixes, elapsed):
+    totals = {suffix: 0 for suffix in suffixes}
+    total_original = 0
+    for path, (original, sizes) in results.items():
+        total_original += original
+        columns = []
+        for suffix in suffixes:
+            size = sizes[suffix]
+            # Clients get the original when no smaller sibling exists
+            totals[suffix] += size if size is not None else original
+            if size is None:
+                columns.append(f"{suffix} skipped")
+            else:
+                columns.append(f"{suffix} {size} ({100 * (1 - size / original):.0f}% smaller)")
+        print(f"{path}: {original} bytes, " + ", ".join(columns))
+
+    columns = [
+        f"{suffix} {total} ({100 * (1 - total / total_original):.0f}% smaller)"
+        for suffix, total in totals.items()
+        if total_original
+    ]
+    print(
+        f"Compressed {len(results)} assets in {elapsed:.2f}s: {total_original} bytes, "
+        + ", ".join(columns)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write .gz/.br siblings of the text assets")
+    parser.add_argument("--force", action="store_true", help="recompress every asset")
+    args = parser.parse_args()
+    build_all(force=args.force)
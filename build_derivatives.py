@@ -0,0 +1,233 @@
+"""
+Build responsive derivatives of the class and subclass art.
+
+Every image in classes/ and subclasses/ is resized to a set of widths and
+encoded as WebP plus a palette-quantized PNG fallback under derivatives/. The
+manifest image-derivatives.json lists the variants per source image so the
+page can build srcset attributes from the WebP ones; the PNG variants are
+there for clients without WebP. Images whose content hash and settings are
+unchanged since the last build are skipped, and derivative files no source
+refers to any more are removed.
+"""
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, features
+
+from result_cache import file_digest
+
+
+SOURCE_FOLDERS = ("classes", "subclasses")
+OUTPUT_DIR = "derivatives"
+MANIFEST_PATH = "image-derivatives.json"
+
+DEFAULT_WIDTHS = (320, 480, 640, 960)
+
+# Encoder settings per output format
+FORMATS = {
+    "webp": {"quality": 80, "method": 4},
+    "png": {"optimize": True},
+}
+
+# The PNG fallback is palette-quantized; truecolour PNG at these sizes is
+# larger than the WebP variants by more than an order of magnitude
+PNG_COLORS = 256
+
+
+def available_formats():
+    """The configured formats this Pillow build can encode."""
+    return [fmt for fmt in FORMATS if fmt == "png" or features.check(fmt)]
+
+
+def derivative_path(source_path, width, fmt):
+    folder = os.path.basename(os.path.dirname(source_path))
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(OUTPUT_DIR, folder, f"{name}-{width}.{fmt}")
+
+
+def save_atomic(img, path, fmt, options):
+    tmp_path = f"{path}.tmp"
+    try:
+        img.save(tmp_path, fmt.upper(), **options)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def build_image(source_path, widths, formats):
+    """Decode one source image once and write every width/format derivative."""
+    start = time.perf_counter()
+    with Image.open(source_path) as img:
+        img.load()
+        source_width, source_height = img.size
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+
+        sources = {fmt: [] for fmt in formats}
+        # Never upscale: widths at or above the source size are skipped, the
+        # original file is the largest candidate
+        for width in sorted(w for w in widths if w < source_width):
+            height = round(source_height * width / source_width)
+            resized = img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+            for fmt in formats:
+                path = derivative_path(source_path, width, fmt)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if fmt == "png":
+                    output = resized.quantize(PNG_COLORS, method=Image.Quantize.FASTOCTREE)
+                else:
+                    output = resized
+                save_atomic(output, path, fmt, FORMATS[fmt])
+                sources[fmt].append(
+                    {
+                        "src": path.replace(os.sep, "/"),
+                        "width": width,
+                        "bytes": os.path.getsize(path),
+                    }
+                )
+
+    return {
+        "width": source_width,
+        "height": source_height,
+        "bytes": os.path.getsize(source_path),
+        "sources": sources,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+def build_task(task):
+    source_path, widths, formats = task
+    try:
+        return build_image(source_path, widths, formats)
+    except Exception as e:
+        print(f"Error building derivatives for {source_path}: {e}")
+        return None
+
+
+def outputs_exist(entry):
+    return all(
+        os.path.exists(variant["src"])
+        for variants in entry["sources"].values()
+        for variant in variants
+    )
+
+
+def build_all(widths=DEFAULT_WIDTHS, jobs=1, force=False):
+    formats = available_formats()
+    manifest = {}
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, "r") as f:
+            manifest = json.load(f)
+
+    settings = {
+        "widths": sorted(widths),
+        "formats": {fmt: FORMATS[fmt] for fmt in formats},
+        "png_colors": PNG_COLORS,
+    }
+    sources = [
+        os.path.join(folder, image_file).replace(os.sep, "/")
+        for folder in SOURCE_FOLDERS
+        if os.path.exists(folder)
+        for image_file in sorted(os.listdir(folder))
+        if image_file.endswith(".png")
+    ]
+
+    start = time.perf_counter()
+    digests = {}
+    pending = []
+    for source_path in sources:
+        digests[source_path] = file_digest(source_path)
+        entry = manifest.get(source_path)
+        if (
+            not force
+            and entry
+            and entry.get("sha256") == digests[source_path]
+            and entry.get("settings") == settings
+            and outputs_exist(entry)
+        ):
+            continue
+        pending.append(source_path)
+
+    tasks = [(source_path, widths, formats) for source_path in pending]
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(build_task, tasks, chunksize=1))
+    else:
+        results = [build_task(task) for task in tasks]
+
+    for source_path, result in zip(pending, results):
+        if result is None:
+            continue
+        elapsed = result.pop("elapsed")
+        result["sha256"] = digests[source_path]
+        result["settings"] = settings
+        manifest[source_path] = result
+        print(f"Built {source_path} in {elapsed:.2f}s")
+
+    # Drop entries for sources that no longer exist
+    manifest = {path: manifest[path] for path in sources if path in manifest}
+
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+    remove_stale_outputs(manifest)
+
+    print_report(manifest, len(sources) - len(pending), time.perf_counter() - start)
+    return manifest
+
+
+def remove_stale_outputs(manifest):
+    """Delete files under OUTPUT_DIR that no manifest entry lists, such as
+    variants of removed sources or of formats and widths no longer built."""
+    wanted = {
+        os.path.normpath(variant["src"])
+        for entry in manifest.values()
+        for variants in entry["sources"].values()
+        for variant in variants
+    }
+    removed = 0
+    for root, _, files in os.walk(OUTPUT_DIR):
+        for name in files:
+            path = os.path.normpath(os.path.join(root, name))
+            if path not in wanted:
+                os.remove(path)
+                removed += 1
+    if removed:
+        print(f"Removed {removed} stale derivative files")
+
+
+def print_report(manifest, skipped, elapsed):
+    original = sum(entry["bytes"] for entry in manifest.values())
+    # What a page pays when every image is served from its largest WebP variant
+    largest_webp = 0
+    for entry in manifest.values():
+        variants = entry["sources"].get("webp") or []
+        largest_webp += max((s["bytes"] for s in variants), default=entry["bytes"])
+    ratio = original / largest_webp if largest_webp else 0.0
+    print(
+        f"Derivatives for {len(manifest)} images ({skipped} unchanged) in {elapsed:.2f}s; "
+        f"originals {original / 1e6:.1f} MB, largest WebP variants {largest_webp / 1e6:.1f} MB "
+        f"({ratio:.0f}x smaller)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build responsive image derivatives")
+    parser.add_argument(
+        "--widths",
+        type=int,
+        nargs="+",
+        default=list(DEFAULT_WIDTHS),
+        help=f"output widths in pixels (default: {' '.join(map(str, DEFAULT_WIDTHS))})",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes"
+    )
+    parser.add_argument("--force", action="store_true", help="rebuild every image")
+    args = parser.parse_args()
+    build_all(widths=args.widths, jobs=args.jobs, force=args.force)
@@ -0,0 +1,430 @@
+"""
+Long-lived frame detection service.
+
+Keeps a pool of warm worker processes, with NumPy and OpenCV already imported
+and initialized and the frame mask buffers allocated. Answers JSON-lines
+requests on a Unix socket (--socket PATH) or on stdin/stdout, so other tooling
+can run detection repeatedly without paying the interpreter and library
+startup each time.
+
+A request is one JSON object per line:
+
+    {"id": 1, "path": "subclasses/Thief Rogue.png"}
+    {"id": 2, "data": "<base64 PNG/WebP bytes>", "is_class": true, "offset": false}
+
+with optional parameters is_class (default false), smooth_contours (default
+true), coarse_scale (1 or 2, default 1), expected_ratio, bounds and offset (whether to
+compute each, default true) and reduce (decode the offset at 1/N size, as
+image-analyzer.py --fast does). Relative paths are resolved against the
+service's working directory. The response echoes the id:
+
+    {"id": 1, "bounds": {...}, "offset": -2.4,
+     "latency_ms": {"total": 41.2, "queue": 0.3, "decode": 21.0, "bounds": 15.6, "offset": 4.1}}
+
+Failures add an "error" field; bounds or offset is null when it was not
+computed. Requests on one connection run concurrently, so responses can
+arrive out of order; match them by id. {"op": "ping"} answers with the
+number of workers.
+
+`python detect_service.py --connect PATH image...` sends images to a running
+service and prints the responses and their latency.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import signal
+import socket
+import argparse
+import importlib
+import multiprocessing
+import threading
+import socketserver
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+
+import process_images
+from downloader import percentile
+
+analyzer = importlib.import_module("image-analyzer")
+
+WORKERS = os.cpu_count() or 1
+DEFAULT_PARAMS = {
+    "is_class": False,
+    "smooth_contours": True,
+    "coarse_scale": 1,
+    "expected_ratio": None,
+    "bounds": True,
+    "offset": True,
+    "reduce": None,
+}
+
+
+def warm_worker(ready):
+    """
+    Worker initializer: keep stdout free for responses, use one OpenCV thread,
+    run OpenCV's lazy setup, then wait on the ready barrier with the other
+    workers and the service.
+    """
+    # Detection and analysis print progress; in stdin mode stdout is the response channel
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    process_images.init_worker()
+    # A small frame-coloured square runs every OpenCV path detection uses once
+    img = np.zeros((64, 64, 4), np.uint8)
+    img[8:56, 8:56] = (*process_images.FRAME_COLOR_BGR, 255)
+    process_images.shared_engine().reserve(1024 * 1024)
+    for smooth_contours in (True, False):
+        try:
+            process_images.find_frame_bounds_in_array(
+                img, smooth_contours=smooth_contours, engine=process_images.shared_engine()
+            )
+        except ValueError:
+            pass
+    analyzer.offset_from_pixels(img)
+    ready.wait()
+
+
+def started():
+    """Startup task; submitting one per worker brings the workers up."""
+
+
+def decode(request, flags):
+    """Decode the request's image with cv2 flags, from its path or its bytes."""
+    if "data" in request:
+        buffer = np.frombuffer(request["data"], np.uint8)
+        img = cv2.imdecode(buffer, flags)
+        source = "request data"
+    else:
+        img = cv2.imread(request["path"], flags)
+        source = request["path"]
+    if img is None:
+        raise ValueError(f"Could not decode {source}")
+    return img
+
+
+def detect(request):
+    """
+    Run one request in a worker. Returns the bounds, the offset and the time
+    of each stage in seconds.
+    """
+    timings = {}
+    result = {"bounds": None, "offset": None}
+    source = request.get("path", "request data")
+
+    img = None
+    if request["bounds"] or request["reduce"] is None:
+        start = time.perf_counter()
+        img = decode(request, cv2.IMREAD_UNCHANGED)
+        timings["decode"] = time.perf_counter() - start
+
+    if request["bounds"]:
+        start = time.perf_counter()
+        result["bounds"] = process_images.find_frame_bounds_in_array(
+            img,
+            request["is_class"],
+            request["smooth_contours"],
+            source=source,
+            coarse_scale=request["coarse_scale"],
+            expected_ratio=request["expected_ratio"],
+            engine=process_images.shared_engine(),
+        )
+        timings["bounds"] = time.perf_counter() - start
+
+    if request["offset"]:
+        if request["reduce"] is not None:
+            start = time.perf_counter()
+            img = decode(request, analyzer.REDUCED_GRAYSCALE[request["reduce"]])
+            timings["reduced_decode"] = time.perf_counter() - start
+        start = time.perf_counter()
+        result["offset"] = analyzer.offset_from_pixels(img, source)
+        timings["offset"] = time.perf_counter() - start
+    result["timings"] = timings
+    return result
+
+
+def parse_request(request):
+    """Validate a decoded request; returns it with defaults filled in."""
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+    if request.get("op", "detect") not in ("detect", "ping"):
+        raise ValueError(f"unknown op {request['op']!r}")
+    if request.get("op") == "ping":
+        return request
+    unknown = set(request) - set(DEFAULT_PARAMS) - {"id", "op", "path", "data"}
+    if unknown:
+        raise ValueError(f"unknown field(s) {', '.join(sorted(unknown))}")
+    if ("path" in request) == ("data" in request):
+        raise ValueError("request needs exactly one of path or data")
+    request = {**DEFAULT_PARAMS, **request}
+    if "data" in request:
+        request["data"] = base64.b64decode(request["data"], validate=True)
+    else:
+        request["path"] = os.path.abspath(request["path"])
+    # bool is an int subclass, and True == 1, so JSON true/false is rejected explicitly
+    if request["reduce"] is not None and (
+        isinstance(request["reduce"], bool) or request["reduce"] not in analyzer.REDUCED_GRAYSCALE
+    ):
+        raise ValueError(f"reduce must be one of {sorted(analyzer.REDUCED_GRAYSCALE)}")
+    coarse_scale = request["coarse_scale"]
+    if isinstance(coarse_scale, bool) or coarse_scale not in process_images.COARSE_SCALES:
+        raise ValueError(f"coarse_scale must be one of {list(process_images.COARSE_SCALES)}")
+    expected_ratio = request["expected_ratio"]
+    if expected_ratio is not None and (
+        isinstance(expected_ratio, bool) or not isinstance(expected_ratio, (int, float))
+    ):
+        raise ValueError("expected_ratio must be a number")
+    for flag in ("is_class", "smooth_contours", "bounds", "offset"):
+        if not isinstance(request[flag], bool):
+            raise ValueError(f"{flag} must be true or false")
+    return request
+
+
+class DetectService:
+    """The worker pool. A pool broken by a crashed worker is replaced on the next request."""
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.start_pool()
+
+    def start_pool(self):
+        start = time.perf_counter()
+        context = multiprocessing.get_context()
+        ready = context.Barrier(self.workers + 1)
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context, initializer=warm_worker, initargs=(ready,)
+        )
+        # Workers start on the first submissions; the barrier holds each one
+        # until all of them are warm, so none sits idle while others still start
+        futures = [pool.submit(started) for _ in range(self.workers)]
+        ready.wait()
+        for future in futures:
+            future.result()
+        self.pool = pool
+        log(f"Started {self.workers} warm workers in {(time.perf_counter() - start) * 1e3:.0f} ms")
+
+    def submit(self, request):
+        with self.lock:
+            try:
+                return self.pool.submit(detect, request)
+            except BrokenProcessPool:
+                log("Worker pool broken; restarting it")
+                self.pool.shutdown(wait=False)
+                self.start_pool()
+                return self.pool.submit(detect, request)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def respond(request_id, received, outcome=None, error=None):
+    response = {"id": request_id}
+    total = time.perf_counter() - received
+    if outcome is not None:
+        response["bounds"] = outcome["bounds"]
+        response["offset"] = outcome["offset"]
+        timings = outcome["timings"]
+        latency = {"total": total, "queue": total - sum(timings.values()), **timings}
+        response["latency_ms"] = {stage: round(t * 1e3, 2) for stage, t in latency.items()}
+    else:
+        response["error"] = error
+        response["latency_ms"] = {"total": round(total * 1e3, 2)}
+    return response
+
+
+def serve_stream(service, rfile, wfile):
+    """Answer every request line from rfile on wfile; returns once all are answered."""
+    write_lock = threading.Lock()
+    done = threading.Condition()
+    pending = 0
+
+    def write(response):
+        data = (json.dumps(response) + "\n").encode()
+        with write_lock:
+            try:
+                wfile.write(data)
+                wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def finish(future, request_id, received):
+        nonlocal pending
+        try:
+            write(respond(request_id, received, outcome=future.result()))
+        except (ValueError, TypeError, OSError, cv2.error) as e:
+            # ValueError also covers "not enough frame edges"
+            write(respond(request_id, received, error=str(e)))
+        except BrokenProcessPool:
+            write(respond(request_id, received, error="worker process died"))
+        except Exception as e:
+            # Anything else still gets an answer, or the client waits forever
+            write(respond(request_id, received, error=f"{type(e).__name__}: {e}"))
+        finally:
+            with done:
+                pending -= 1
+                done.notify_all()
+
+    for line in rfile:
+        if not line.strip():
+            continue
+        received = time.perf_counter()
+        request_id = None
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                request_id = request.get("id")
+            request = parse_request(request)
+        except (ValueError, TypeError) as e:
+            # ValueError covers malformed JSON and base64
+            write(respond(request_id, received, error=f"bad request: {e}"))
+            continue
+        if request.get("op") == "ping":
+            write({"id": request_id, "workers": service.workers})
+            continue
+        try:
+            future = service.submit(request)
+        except Exception as e:
+            # E.g. the pool could not be restarted
+            write(respond(request_id, received, error=f"{type(e).__name__}: {e}"))
+            continue
+        with done:
+            pending += 1
+        future.add_done_callback(lambda future, i=request_id, t=received: finish(future, i, t))
+    with done:
+        done.wait_for(lambda: pending == 0)
+
+
+class ConnectionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        serve_stream(self.server.service, self.rfile, self.wfile)
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve_socket(service, path):
+    if os.path.exists(path):
+        # A stale socket from a previous run; refuse to replace a live one
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+        else:
+            raise SystemExit(f"A service is already listening on {path}")
+        finally:
+            probe.close()
+    old_umask = os.umask(0o077)
+    try:
+        server = UnixServer(path, ConnectionHandler)
+    finally:
+        os.umask(old_umask)
+    server.service = service
+    log(f"Listening on {path}")
+    with server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+class DetectClient:
+    """Sends requests to a service socket one at a time."""
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.connect(path)
+        self.file = self.socket.makefile("rwb")
+        self.next_id = 0
+
+    def request(self, **request):
+        self.next_id += 1
+        request.setdefault("id", self.next_id)
+        self.file.write((json.dumps(request) + "\n").encode())
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("service closed the connection")
+        return json.loads(line)
+
+    def detect(self, path=None, data=None, **params):
+        if data is not None:
+            return self.request(data=base64.b64encode(data).decode("ascii"), **params)
+        return self.request(path=path, **params)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def query(path, images, params, repeat=1):
+    """Send images to a running service and print the responses and round-trip latency."""
+    round_trips = []
+    with DetectClient(path) as client:
+        for _ in range(repeat):
+            for image in images:
+                start = time.perf_counter()
+                response = client.detect(os.path.abspath(image), **params)
+                round_trips.append(time.perf_counter() - start)
+                print(json.dumps(response))
+    round_trips.sort()
+    print(
+        f"{len(round_trips)} requests: round trip p50 {percentile(round_trips, 50) * 1e3:.1f} ms, "
+        f"p95 {percentile(round_trips, 95) * 1e3:.1f} ms, max {round_trips[-1] * 1e3:.1f} ms",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve frame detection from warm worker processes")
+    parser.add_argument("--socket", metavar="PATH", help="listen on a Unix socket instead of stdin")
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS, help=f"worker processes (default: {WORKERS})"
+    )
+    parser.add_argument(
+        "--connect", metavar="PATH", help="send the given images to the service on PATH"
+    )
+    parser.add_argument("images", nargs="*", help="images to send with --connect")
+    parser.add_argument("--class", dest="is_class", action="store_true", help="with --connect: class art")
+    parser.add_argument("--no-offset", action="store_true", help="with --connect: skip offsets")
+    parser.add_argument("--repeat", type=int, default=1, help="with --connect: send each image N times")
+    args = parser.parse_args()
+
+    if args.connect:
+        query(
+            args.connect,
+            args.images,
+            {"is_class": args.is_class, "offset": not args.no_offset},
+            args.repeat,
+        )
+        sys.exit(0)
+
+    # Shut the workers down and remove the socket on TERM too, not only on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    service = DetectService(args.workers)
+    try:
+        if args.socket:
+            serve_socket(service, args.socket)
+        else:
+            serve_stream(service, sys.stdin.buffer, sys.stdout.buffer)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,383 @@
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+import instrument
+from result_cache import CACHE_DIR
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+CHUNK_SIZE = 64 * 1024
+
+MANIFEST_PATH = os.path.join(CACHE_DIR, "download_manifest.json")
+
+# Magic bytes of the source formats we expect to receive
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stream_to_file(response, path, known_digest=None):
+    """
+    Write a streamed response body to path chunk by chunk, hashing it on the way.
+    Returns (sha256 hex digest, size in bytes). The file is removed on failure.
+
+    With known_digest (the hash of the copy already on disk) the body is held in
+    memory instead, and path is only written if its hash turns out different, so
+    an unchanged refresh touches nothing on disk.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    if known_digest is not None:
+        chunks = []
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            chunks.append(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+        if digest.hexdigest() == known_digest:
+            return known_digest, size
+        try:
+            with open(path, "wb") as f:
+                f.writelines(chunks)
+        except BaseException:
+            remove_quietly(path)
+            raise
+        return digest.hexdigest(), size
+
+    try:
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        remove_quietly(path)
+        raise
+    return digest.hexdigest(), size
+
+
+def sniff_format(path):
+    """Identify an image file from its magic bytes: "png", "webp", "jpeg" or None."""
+    with open(path, "rb") as f:
+        header = f.read(16)
+    if header.startswith(PNG_SIGNATURE):
+        return "png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header.startswith(JPEG_SIGNATURE):
+        return "jpeg"
+    return None
+
+
+def save_png_atomic(source_path, save_path, compress_level=6, optimize=False):
+    """Decode source_path and write it as PNG to save_path via a temporary file and rename."""
+    tmp_path = f"{save_path}.tmp"
+    try:
+        with Image.open(source_path) as img:
+            img.save(tmp_path, "PNG", compress_level=compress_level, optimize=optimize)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        remove_quietly(tmp_path)
+        raise
+
+
+class Manifest:
+    """
+    On-disk record of what was last downloaded for each URL: ETag, Last-Modified,
+    content hash and output path. Used to send conditional requests and skip
+    unchanged images.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, url, save_path):
+        """Return the entry for url if its output file is still on disk."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry and entry.get("path") == save_path and os.path.exists(save_path):
+            return entry
+        return None
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def update(self, url, entry):
+        with self.lock:
+            if self.entries.get(url) != entry:
+                self.entries[url] = entry
+                self.dirty = True
+
+    def save(self):
+        """Write the manifest atomically, and only if something changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+class HostLimiter:
+    """Bound the number of parallel requests and the request rate for one host."""
+
+    def __init__(self, max_parallel, rate):
+        self.semaphore = threading.BoundedSemaphore(max_parallel)
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        # Reserve the next start slot for this host, then wait for it outside the lock
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_slot)
+            self.next_slot = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+        return False
+
+
+class Downloader:
+    """
+    Shared download engine: one keep-alive connection pool, a bounded number of
+    parallel requests per host and a per-host rate limit.
+
+    PNG payloads are written to disk unchanged when passthrough is enabled; other
+    formats (WebP/JPEG) are converted to PNG using compress_level and optimize.
+    """
+
+    def __init__(
+        self,
+        max_workers=8,
+        per_host=4,
+        rate=4.0,
+        timeout=10,
+        headers=None,
+        manifest=None,
+        passthrough=True,
+        compress_level=6,
+        optimize=False,
+    ):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.rate = rate
+        self.timeout = timeout
+        self.manifest = manifest
+        self.passthrough = passthrough
+        self.compress_level = compress_level
+        self.optimize = optimize
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def close(self):
+        if self.manifest is not None:
+            self.manifest.save()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def limiter(self, url):
+        host = urlparse(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostLimiter(self.per_host, self.rate)
+            return self._limiters[host]
+
+    def download(self, url, save_path, timeout=None):
+        """
+        Download one image and save it as PNG.
+        Returns a result dict with the bytes received and whether the file was
+        "saved" or left "unchanged". timeout overrides the engine's for this call.
+        """
+        entry = self.manifest.get(url, save_path) if self.manifest is not None else None
+        headers = self.manifest.conditional_headers(entry) if entry else {}
+
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        # The raw body is streamed next to the destination so memory stays flat and
+        # the final PNG only ever appears through an atomic rename. A refresh of a
+        # known file is hashed in memory first and written only if it changed.
+        download_path = f"{save_path}.download"
+
+        with self.limiter(url), instrument.span("fetch", image=url) as span:
+            with self.session.get(
+                url, headers=headers, timeout=timeout or self.timeout, stream=True
+            ) as response:
+                if response.status_code == 304:
+                    print(f"Unchanged {save_path} (304)")
+                    span.set(bytes=0, status=304)
+                    return {"url": url, "path": save_path, "bytes": 0, "status": "unchanged"}
+                response.raise_for_status()
+                digest, size = stream_to_file(
+                    response, download_path, entry.get("sha256") if entry else None
+                )
+                span.set(bytes=size, status=response.status_code)
+
+        return self.store(
+            url,
+            save_path,
+            entry,
+            download_path,
+            digest,
+            size,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+
+    def store(self, url, save_path, entry, download_path, digest, size, etag, last_modified):
+        """
+        Move a received body from download_path into place as save_path (as PNG)
+        unless the manifest entry already has its content hash, and record it.
+        """
+        try:
+            status = "unchanged"
+            if entry is None or entry.get("sha256") != digest:
+                with instrument.span("save", image=url) as span:
+                    if self.passthrough and sniff_format(download_path) == "png":
+                        # Already PNG: no decode or re-encode needed
+                        os.replace(download_path, save_path)
+                        print(f"Saved {save_path} (passthrough)")
+                        span.set(bytes=size, passthrough=True)
+                    else:
+                        save_png_atomic(
+                            download_path, save_path, self.compress_level, self.optimize
+                        )
+                        print(f"Saved {save_path}")
+                        span.set(bytes=os.path.getsize(save_path), passthrough=False)
+                status = "saved"
+            else:
+                print(f"Unchanged {save_path} (same content hash)")
+        finally:
+            remove_quietly(download_path)
+
+        if self.manifest is not None:
+            self.manifest.update(
+                url,
+                {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "sha256": digest,
+                    "path": save_path,
+                },
+            )
+        return {"url": url, "path": save_path, "bytes": size, "status": status}
+
+    def _download_job(self, job):
+        url, save_path = job
+        start = time.perf_counter()
+        try:
+            result = self.download(url, save_path)
+        except Exception as e:
+            print(f"Error downloading {url}: {e}")
+            return None
+        result["elapsed"] = time.perf_counter() - start
+        return result
+
+    def download_all(self, jobs):
+        """
+        Download a list of (url, save_path) pairs in parallel.
+        Returns a summary dict with counts, bytes and wall time.
+        """
+        jobs = list(jobs)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(self._download_job, jobs))
+        elapsed = time.perf_counter() - start
+
+        if self.manifest is not None:
+            self.manifest.save()
+
+        summary = make_summary(len(jobs), results, elapsed)
+        print_summary(summary)
+        return summary
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    # The smallest value with at least pct percent of the values at or below it
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100) - 1))
+    return sorted_values[rank]
+
+
+def make_summary(total, results, elapsed):
+    """Counts, bytes, wall time and per-file latency of a batch; failed jobs are None."""
+    received = [r for r in results if r is not None]
+    latencies = sorted(r["elapsed"] for r in received if "elapsed" in r)
+    return {
+        "total": total,
+        "succeeded": len(received),
+        "unchanged": sum(1 for r in received if r["status"] == "unchanged"),
+        "failed": total - len(received),
+        "bytes": sum(r["bytes"] for r in received),
+        "elapsed": elapsed,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+    }
+
+
+def print_summary(summary):
+    elapsed = summary["elapsed"]
+    throughput = summary["bytes"] / elapsed if elapsed > 0 else 0.0
+    latency = summary["latency"]
+    print(
+        f"Downloaded {summary['succeeded']}/{summary['total']} files "
+        f"({summary['unchanged']} unchanged), "
+        f"{summary['bytes']} bytes in {elapsed:.2f}s ({throughput / 1024:.1f} KiB/s); "
+        f"per file p50 {latency['p50'] * 1e3:.0f} ms, p95 {latency['p95'] * 1e3:.0f} ms, "
+        f"p99 {latency['p99'] * 1e3:.0f} ms"
+    )
@@ -0,0 +1,156 @@
+"""
+Local HTTP stand-in for the image hosts, for exercising the downloaders offline.
+
+Serves a directory (by default this one, so classes/ and subclasses/ hold the
+fixture images) with server.py's handler. Each request can be delayed by
+--latency plus up to --jitter seconds. A --failure-rate fraction of requests
+fail in one of the --failures modes:
+
+    status    503 with Retry-After: 0
+    reset     the connection is reset before any response
+    stall     the response is held back for --stall seconds (past the client timeout)
+    truncate  the headers announce the full length but only half the body is sent
+
+Failures come from a seeded random generator, so runs are repeatable.
+"""
+import io
+import os
+import time
+import random
+import socket
+import struct
+import argparse
+import threading
+
+import server
+
+PORT = 8001
+FAILURE_MODES = ("status", "reset", "stall", "truncate")
+
+
+class FixtureHandler(server.StaticHandler):
+    latency = 0.0
+    jitter = 0.0
+    failure_rate = 0.0
+    failures = FAILURE_MODES
+    stall = 30.0
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    def draw(self):
+        """(delay, failure mode or None) for this request."""
+        with self.rng_lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            failure = None
+            if self.failures and self.rng.random() < self.failure_rate:
+                failure = self.rng.choice(self.failures)
+        return delay, failure
+
+    def send_head(self):
+        self.truncate = False
+        delay, failure = self.draw()
+        if delay > 0:
+            time.sleep(delay)
+        if failure == "status":
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if failure == "reset":
+            # SO_LINGER with a zero timeout turns the close into a RST
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return None
+        if failure == "stall":
+            time.sleep(self.stall)
+        self.truncate = failure == "truncate"
+        return super().send_head()
+
+    def copyfile(self, source, outputfile):
+        if not self.truncate or isinstance(source, io.BytesIO):
+            # Directory listings are in memory and always sent whole
+            return super().copyfile(source, outputfile)
+        # Half the body, then drop the connection mid-response
+        source.seek(0)
+        outputfile.write(source.read(max(1, os.fstat(source.fileno()).st_size // 2)))
+        self.close_connection = True
+
+
+def make_fixture_server(
+    port=PORT,
+    bind="127.0.0.1",
+    directory=".",
+    latency=0.0,
+    jitter=0.0,
+    failure_rate=0.0,
+    failures=FAILURE_MODES,
+    stall=30.0,
+    seed=0,
+):
+    handler = type(
+        "FixtureHandler",
+        (FixtureHandler,),
+        {
+            "latency": latency,
+            "jitter": jitter,
+            "failure_rate": failure_rate,
+            "failures": tuple(failures),
+            "stall": stall,
+            "rng": random.Random(seed),
+            "rng_lock": threading.Lock(),
+        },
+    )
+    # No hot cache: truncation needs a real file to read from
+    return server.make_server(
+        port, bind, directory, handler=handler, hot_cache_bytes=0, log_requests=False
+    )
+
+
+def parse_failures(text):
+    modes = tuple(mode.strip() for mode in text.split(",") if mode.strip())
+    unknown = set(modes) - set(FAILURE_MODES)
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown failure mode(s) {', '.join(sorted(unknown))}; choose from {', '.join(FAILURE_MODES)}"
+        )
+    return modes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fixture images with latency and failures")
+    parser.add_argument("--port", type=int, default=PORT, help=f"port to listen on (default: {PORT})")
+    parser.add_argument("--bind", default="127.0.0.1", help="address to bind (default: 127.0.0.1)")
+    parser.add_argument("--directory", default=".", help="directory to serve")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra random seconds")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="fraction of requests that fail (default: 0)"
+    )
+    parser.add_argument(
+        "--failures",
+        type=parse_failures,
+        default=FAILURE_MODES,
+        help=f"comma-separated failure modes (default: {','.join(FAILURE_MODES)})",
+    )
+    parser.add_argument("--stall", type=float, default=30.0, help="seconds a stalled response waits")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for latency and failures")
+    args = parser.parse_args()
+
+    httpd = make_fixture_server(
+        args.port,
+        args.bind,
+        args.directory,
+        args.latency,
+        args.jitter,
+        args.failure_rate,
+        args.failures,
+        args.stall,
+        args.seed,
+    )
+    print(f"Fixture server at http://{args.bind}:{args.port}")
+    with httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
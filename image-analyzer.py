@@ -1,58 +1,141 @@
 import os
 import json
+import argparse
 import cv2
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+from result_cache import CACHE_DIR, ResultCache, file_digest
+
+# Grey level separating the artwork from the dark background
+THRESHOLD = 30
+
+# Bump when a change to analyze_image alters its results, so cached offsets
+# are recomputed
+OFFSET_VERSION = 1
+
+# imread flags that decode straight to grayscale at 1/N size
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def analyze_image(image_path, reduce=None):
+    """
+    Analyze an image to determine the centering offset needed.
+    With reduce (1, 2, 4 or 8) the image is decoded directly to grayscale at
+    1/reduce size instead of full colour; offsets can shift by up to about 2
+    percentage points.
+    """
+    try:
+        with instrument.span("analyze_image", image=image_path):
+            return analyze_image_stages(image_path, reduce)
+    except Exception as e:
+        print(f"Error processing {image_path}: {e}")
+        return None
 
 
-def analyze_image(image_path):
-    """Analyze an image to determine the centering offset needed."""
-    try:
+def analyze_image_stages(image_path, reduce):
+    with instrument.span("decode", reduce=reduce) as span:
         # Read the image
-        img = cv2.imread(str(image_path))
-        if img is None:
-            print(f"Could not read image: {image_path}")
-            return None
+        if reduce is None:
+            img = cv2.imread(str(image_path))
+        else:
+            img = cv2.imread(str(image_path), REDUCED_GRAYSCALE[reduce])
+        if img is not None:
+            span.set(bytes=img.nbytes)
+    if img is None:
+        print(f"Could not read image: {image_path}")
+        return None
+    return offset_from_pixels(img, image_path)
+
 
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+def offset_from_pixels(img, image_path="image"):
+    """Centering offset of an already decoded BGR, BGRA or grayscale array."""
+    with instrument.span("threshold"):
+        # Convert to grayscale; alpha is ignored, as cv2.imread drops it
+        if img.ndim == 2:
+            gray = img
+        elif img.shape[2] == 4:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
         # Apply thresholding to separate foreground from background
-        _, thresh = cv2.threshold(gray, 30, 255, cv2.THRESH_BINARY)
+        _, thresh = cv2.threshold(gray, THRESHOLD, 255, cv2.THRESH_BINARY)
 
+    with instrument.span("contours"):
         # Find contours to detect the main content
         contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-        if not contours:
-            print(f"No contours found in {image_path}")
-            return None
-
-        # Find the largest contour (likely the main content)
-        main_contour = max(contours, key=cv2.contourArea)
-
-        # Get the bounding rectangle
-        x, y, w, h = cv2.boundingRect(main_contour)
-
-        # Calculate the center of the content vs. the center of the image
-        image_center_x = img.shape[1] / 2
-        content_center_x = x + (w / 2)
-
-        # Calculate the offset percentage
-        offset_percentage = ((image_center_x - content_center_x) / image_center_x) * 100
-
-        # Round to one decimal place for precision
-        offset_percentage = round(offset_percentage, 1)
-
-        print(f"Analyzed {image_path.name}: offset = {offset_percentage}%")
-        return offset_percentage
-
-    except Exception as e:
-        print(f"Error processing {image_path}: {e}")
+    if not contours:
+        print(f"No contours found in {image_path}")
         return None
 
-
-def generate_offset_config():
-    """Generate a configuration file with image offsets."""
+    # Find the largest contour (likely the main content)
+    main_contour = max(contours, key=cv2.contourArea)
+
+    # Get the bounding rectangle
+    x, y, w, h = cv2.boundingRect(main_contour)
+
+    # Calculate the center of the content vs. the center of the image
+    image_center_x = img.shape[1] / 2
+    content_center_x = x + (w / 2)
+
+    # Calculate the offset percentage
+    offset_percentage = ((image_center_x - content_center_x) / image_center_x) * 100
+
+    # Round to one decimal place for precision
+    offset_percentage = round(offset_percentage, 1)
+
+    print(f"Analyzed {Path(image_path).name}: offset = {offset_percentage}%")
+    return offset_percentage
+
+
+def merge_offsets(config_path, offsets, changed, sources=None):
+    """
+    Merge offsets into an existing config, touching only entries for changed
+    images or ones missing from the file. sources is the set of image names
+    that still exist; entries for any other name are dropped (None keeps
+    them). Writes atomically, and only if needed. Returns the number of
+    entries updated or dropped.
+    """
+    existing = {}
+    if config_path.exists():
+        with open(config_path, "r") as f:
+            existing = json.load(f)
+
+    updated = 0
+    if sources is not None:
+        for image_name in [name for name in existing if name not in sources]:
+            del existing[image_name]
+            updated += 1
+    for image_name, offset in offsets.items():
+        if (image_name in changed or image_name not in existing) and existing.get(
+            image_name
+        ) != offset:
+            existing[image_name] = offset
+            updated += 1
+
+    if updated:
+        tmp_path = config_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(existing, f, indent=2)
+        os.replace(tmp_path, config_path)
+    return updated
+
+
+def generate_offset_config(use_cache=True, fast=False, jobs=1, reduce=2):
+    """
+    Generate a configuration file with image offsets.
+    fast decodes straight to reduced grayscale, analyzes on a worker pool and
+    merges only changed entries into the existing config instead of rewriting it.
+    """
     base_dir = Path(__file__).parent
     subclasses_dir = base_dir / "subclasses"
 
@@ -60,25 +143,93 @@ def generate_offset_config():
         print(f"Subclasses directory not found: {subclasses_dir}")
         return
 
+    reduce_factor = reduce if fast else None
+
     # Dictionary to store image offsets
     offsets = {}
 
+    # Unchanged images are served from the cache, keyed by content and threshold
+    cache = (
+        ResultCache(str(base_dir / CACHE_DIR / "image_offsets.json"), OFFSET_VERSION)
+        if use_cache
+        else None
+    )
+
     # Process all PNG files in the subclasses directory
-    for image_path in subclasses_dir.glob("*.png"):
-        image_name = image_path.stem
-        offset = analyze_image(image_path)
+    image_paths = sorted(subclasses_dir.glob("*.png"))
+    keys = {}
+    pending = []
+    for image_path in image_paths:
+        offset = None
+        if cache is not None:
+            keys[image_path] = cache.key(
+                file_digest(image_path), {"threshold": THRESHOLD, "reduce": reduce_factor}
+            )
+            offset = cache.get(keys[image_path])
+        if offset is None:
+            pending.append(image_path)
+        else:
+            offsets[image_path.stem] = offset
+
+    # OpenCV releases the GIL while decoding, so threads are enough here
+    if jobs > 1 and len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            computed = list(pool.map(lambda path: analyze_image(path, reduce_factor), pending))
+    else:
+        computed = [analyze_image(path, reduce_factor) for path in pending]
+
+    changed = set()
+    for image_path, offset in zip(pending, computed):
         if offset is not None:
-            offsets[image_name] = offset
+            offsets[image_path.stem] = offset
+            changed.add(image_path.stem)
+            if cache is not None:
+                cache.put(keys[image_path], offset)
 
     # Save the offsets to a JSON file
     config_path = base_dir / "image-offsets.json"
-    with open(config_path, "w") as f:
-        json.dump(offsets, f, indent=2)
+    if fast:
+        updated = merge_offsets(
+            config_path, offsets, changed, {image_path.stem for image_path in image_paths}
+        )
+        print(f"Merged {updated} changed entries into {config_path}")
+    else:
+        with open(config_path, "w") as f:
+            json.dump(offsets, f, indent=2)
+        print(f"Generated offset configuration at {config_path}")
 
-    print(f"Generated offset configuration at {config_path}")
     print(f"Analyzed {len(offsets)} images")
+    if cache is not None:
+        cache.save()
+        print(cache.summary())
 
 
 if __name__ == "__main__":
-    generate_offset_config()
+    parser = argparse.ArgumentParser(description="Compute centering offsets for subclass art")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="recompute every image, ignoring the cache"
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="reduced grayscale decode, worker pool, merge only changed entries",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1, help="workers for --fast"
+    )
+    parser.add_argument(
+        "--reduce",
+        type=int,
+        choices=sorted(REDUCED_GRAYSCALE),
+        default=2,
+        help="decode at 1/N size in --fast mode (default: 2)",
+    )
+    args = parser.parse_args()
+    with instrument.profiled(), instrument.span("generate_offset_config"):
+        generate_offset_config(
+            use_cache=not args.no_cache,
+            fast=args.fast,
+            jobs=args.jobs if args.fast else 1,
+            reduce=args.reduce,
+        )
     print("Image analysis complete. Configuration file has been generated.")
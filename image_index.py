@@ -0,0 +1,139 @@
+"""
+Header-only image dimension index.
+
+Reads width and height from the first 30 bytes of each PNG (IHDR) or WebP
+(VP8/VP8L/VP8X) file, so no pixel data is read or decoded. Files are read in
+parallel, and the results are written to image_index.json with each image's
+dimensions and aspect ratio. process_images can use the index to pick a
+per-image expected frame ratio for class art instead of its class constant.
+"""
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+INDEX_PATH = "image_index.json"
+INDEX_VERSION = 1
+IMAGE_FOLDERS = ("classes", "subclasses")
+IMAGE_EXTENSIONS = (".png", ".webp")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+HEADER_BYTES = 30
+
+
+def parse_dimensions(header):
+    """(width, height, format) from the leading bytes of a PNG or WebP file, or None."""
+    if header.startswith(PNG_SIGNATURE) and header[12:16] == b"IHDR":
+        width = int.from_bytes(header[16:20], "big")
+        height = int.from_bytes(header[20:24], "big")
+        return width, height, "png"
+    if len(header) < 30 or header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+        # Lossy key frame: 14-bit dimensions after the start code
+        width = int.from_bytes(header[26:28], "little") & 0x3FFF
+        height = int.from_bytes(header[28:30], "little") & 0x3FFF
+        return width, height, "webp"
+    if chunk == b"VP8L" and header[20] == 0x2F:
+        # Lossless: 14-bit width-1 and height-1 packed after the signature byte
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, "webp"
+    if chunk == b"VP8X":
+        # Extended: 24-bit canvas width-1 and height-1
+        width = int.from_bytes(header[24:27], "little") + 1
+        height = int.from_bytes(header[27:30], "little") + 1
+        return width, height, "webp"
+    return None
+
+
+def read_dimensions(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER_BYTES)
+    dimensions = parse_dimensions(header)
+    if dimensions is None:
+        raise ValueError(f"Not a PNG or WebP file: {path}")
+    return dimensions
+
+
+def list_images(folders=IMAGE_FOLDERS):
+    return [
+        os.path.join(folder, image_file).replace(os.sep, "/")
+        for folder in folders
+        if os.path.exists(folder)
+        for image_file in sorted(os.listdir(folder))
+        if image_file.endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+def scan_entry(path):
+    try:
+        width, height, fmt = read_dimensions(path)
+    except (OSError, ValueError) as e:
+        return {"error": str(e)}
+    return {
+        "width": width,
+        "height": height,
+        "ratio": width / height if height else 0,
+        "format": fmt,
+    }
+
+
+def scan_images(folders=IMAGE_FOLDERS, jobs=8):
+    """Map image path -> dimensions entry for every image in folders."""
+    paths = list_images(folders)
+    # Each read is a single small syscall, so threads keep the disk busy
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        entries = list(pool.map(scan_entry, paths))
+    return dict(zip(paths, entries))
+
+
+def write_index(images, path=INDEX_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": INDEX_VERSION, "images": images}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_index(path=INDEX_PATH):
+    """The images mapping of an index file, or {} if it is missing or outdated."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        data = json.load(f)
+    if data.get("version") != INDEX_VERSION:
+        return {}
+    return data.get("images", {})
+
+
+def expected_ratio(images, image_path, is_class=True):
+    """
+    Expected frame height/width of an indexed image, the form process_images
+    expects, or None to use its constants. Class art is framed edge to edge, so
+    the image's own ratio is the frame's. Subclass art is not (Eldritch Knight
+    is 1.18 against a frame of about 3.1), so subclasses always get None.
+    """
+    if not is_class:
+        return None
+    entry = images.get(str(image_path).replace(os.sep, "/"))
+    if not entry or not entry.get("width"):
+        return None
+    return entry["height"] / entry["width"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index image dimensions from file headers")
+    parser.add_argument("--jobs", type=int, default=8, help="parallel readers (default: 8)")
+    parser.add_argument("--output", default=INDEX_PATH, help=f"index path (default: {INDEX_PATH})")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    images = scan_images(jobs=args.jobs)
+    write_index(images, args.output)
+    errors = sum(1 for entry in images.values() if "error" in entry)
+    print(
+        f"Indexed {len(images)} images ({errors} unreadable) in "
+        f"{(time.perf_counter() - start) * 1e3:.1f} ms, wrote {args.output}"
+    )
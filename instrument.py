@@ -0,0 +1,203 @@
+"""
+Lightweight stage instrumentation for the processing scripts.
+
+Wrap a stage in a span:
+
+    with instrument.span("decode", image=path) as s:
+        img = load(path)
+        s.set(bytes=os.path.getsize(path))
+
+When tracing is enabled, every span appends one JSON line to the trace file
+with the image, stage, duration, bytes and the process's peak RSS. Inner spans
+inherit the image of the span they run in. When tracing is disabled, span()
+returns a shared no-op object, so instrumented code pays for one function call.
+
+Tracing is enabled with the IMAGE_TRACE=<file.jsonl> environment variable,
+which worker processes inherit, or with enable(). IMAGE_PROFILE=<file.prof>
+makes profiled() run the wrapped block under cProfile, dump the stats for
+snakeviz/flameprof/gprof2dot, and print the top functions.
+
+`python instrument.py trace.jsonl` prints per-stage totals of a trace.
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+TRACE_ENV = "IMAGE_TRACE"
+PROFILE_ENV = "IMAGE_PROFILE"
+
+_fd = None
+_lock = threading.Lock()
+# The image of the innermost open span; a context variable rather than a
+# thread-local, so coroutines interleaving on one thread each keep their own
+_image = contextvars.ContextVar("instrument_image", default=None)
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def enable(path):
+    """Append span records to path. The path is exported in IMAGE_TRACE so worker processes trace too."""
+    global _fd
+    disable()
+    # One O_APPEND write per record keeps lines from several processes intact
+    _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.environ[TRACE_ENV] = path
+
+
+def disable():
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+    os.environ.pop(TRACE_ENV, None)
+
+
+def enabled():
+    return _fd is not None
+
+
+def write_record(record):
+    line = (json.dumps(record) + "\n").encode()
+    with _lock:
+        if _fd is not None:
+            os.write(_fd, line)
+
+
+class Span:
+    __slots__ = ("stage", "image", "bytes", "fields", "start", "token")
+
+    def __init__(self, stage, image, bytes, fields):
+        self.stage = stage
+        self.image = image
+        self.bytes = bytes
+        self.fields = fields
+
+    def set(self, bytes=None, **fields):
+        if bytes is not None:
+            self.bytes = bytes
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.token = None
+        if self.image is None:
+            self.image = _image.get()
+        else:
+            self.token = _image.set(self.image)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if self.token is not None:
+            _image.reset(self.token)
+        record = {
+            "ts": time.time(),
+            "pid": os.getpid(),
+            "image": self.image,
+            "stage": self.stage,
+            "duration": duration,
+            "bytes": self.bytes,
+            "peak_rss": peak_rss(),
+        }
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        if self.fields:
+            record.update(self.fields)
+        write_record(record)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def set(self, bytes=None, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, image=None, bytes=None, **fields):
+    """A context manager timing one stage; a shared no-op when tracing is off."""
+    if _fd is None:
+        return NULL_SPAN
+    return Span(stage, str(image) if image is not None else None, bytes, fields)
+
+
+@contextmanager
+def profiled(path=None, top=25):
+    """
+    Run the block under cProfile when path (or IMAGE_PROFILE) is set, then dump
+    the stats to that file and print the top functions by cumulative time.
+    Work done in worker processes is not included.
+    """
+    path = path or os.environ.get(PROFILE_ENV)
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Wrote profile to {path}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+
+
+def summarize(path):
+    """Print the total and mean duration per stage of a trace file, slowest first."""
+    totals = {}
+    peak = 0
+    with open(path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            stage = totals.setdefault(record["stage"], {"count": 0, "duration": 0.0, "bytes": 0})
+            stage["count"] += 1
+            stage["duration"] += record["duration"]
+            stage["bytes"] += record.get("bytes") or 0
+            peak = max(peak, record.get("peak_rss") or 0)
+    for name, stage in sorted(totals.items(), key=lambda item: -item[1]["duration"]):
+        print(
+            f"{name:<24} {stage['count']:6d} spans {stage['duration']:9.3f}s total "
+            f"{stage['duration'] / stage['count'] * 1e3:9.2f} ms mean {stage['bytes'] / 1e6:10.1f} MB"
+        )
+    print(f"Peak RSS of any process: {peak / 1e6:.0f} MB")
+
+
+# Worker processes (and runs started with IMAGE_TRACE set) trace from import
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"usage: {sys.argv[0]} TRACE.jsonl")
+        sys.exit(2)
+    summarize(sys.argv[1])
@@ -1,8 +1,39 @@
 import os
 import cv2
 import json
+import mmap
+import time
+import argparse
 import numpy as np
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+import image_index
+from result_cache import CACHE_DIR, ResultCache, file_digest
+
+# Golden frame colour (#B79461, BGR order) and the HSV tolerance around it
+FRAME_COLOR_BGR = (0x61, 0x94, 0xB7)
+HUE_RANGE = 3
+SAT_RANGE = 40
+VAL_RANGE = 40
+
+# Bump when a change to the detection code alters its results, so cached
+# bounds are recomputed
+FRAME_BOUNDS_VERSION = 1
+
+# Low-memory mode: rows per strip, and rows read either side of a strip (the
+# 3x3 closing reaches 2 rows and the 3x3 Sobel one more)
+STRIP_ROWS = 256
+STRIP_CONTEXT = 3
+# Pyramid levels the CLIs offer for the projection path. Level 2 matches full
+# resolution on every checked-in image; at 4 the bounds of 4 of 51 drift by
+# 7 to 348 px
+COARSE_SCALES = (1, 2)
+# Raw decoded pixels, mapped instead of decoded on later runs
+PIXEL_CACHE_DIR = os.path.join(CACHE_DIR, "pixels")
+# Which source pixels and bounds each processed/*_clipped.png was cut from
+CROP_RECORD_PATH = os.path.join(CACHE_DIR, "crops.json")
+CROP_RECORD_VERSION = 1
 
 
 def rgb_to_hsv(rgb):
@@ -14,26 +45,25 @@ def rgb_to_hsv(rgb):
     return hsv
 
 
-def find_frame_bounds(image_path, is_class=False, smooth_contours=False):
-    # Read image with alpha channel
+def load_image(image_path):
+    """Decode an image once, keeping the alpha channel (BGRA order)."""
     img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    if img is None or img.shape[2] < 4:
+    if img is None or img.ndim < 3 or img.shape[2] < 4:
         raise ValueError(f"Could not load image with alpha: {image_path}")
+    return img
 
-    height, width = img.shape[:2]
-
-    # Convert BGR to HSV
-    hsv = cv2.cvtColor(img[:, :, :3], cv2.COLOR_BGR2HSV)
 
+def frame_hsv_range():
+    """Lower and upper HSV bounds around the golden frame colour."""
     # Create mask for the golden frame color (#B79461)
     # Convert target RGB to HSV
-    target_color = np.uint8([[[0x61, 0x94, 0xB7]]])  # BGR format
+    target_color = np.uint8([[FRAME_COLOR_BGR]])  # BGR format
     target_hsv = cv2.cvtColor(target_color, cv2.COLOR_BGR2HSV)[0][0]
 
     # Define tight range around the golden color
-    hue_range = 3
-    sat_range = 40
-    val_range = 40
+    hue_range = HUE_RANGE
+    sat_range = SAT_RANGE
+    val_range = VAL_RANGE
 
     lower_gold = np.array(
         [
@@ -49,6 +79,14 @@ def find_frame_bounds(image_path, is_class=False, smooth_contours=False):
             min(255, target_hsv[2] + val_range),
         ]
     )
+    return lower_gold, upper_gold
+
+
+def build_frame_mask(img):
+    """Mask of the golden frame colour on opaque pixels of a BGRA array."""
+    # Convert BGR to HSV
+    hsv = cv2.cvtColor(img[:, :, :3], cv2.COLOR_BGR2HSV)
+    lower_gold, upper_gold = frame_hsv_range()
 
     # Create color mask and combine with alpha
     color_mask = cv2.inRange(hsv, lower_gold, upper_gold)
@@ -59,8 +97,354 @@ def find_frame_bounds(image_path, is_class=False, smooth_contours=False):
     kernel = np.ones((3, 3), np.uint8)
     frame_mask = cv2.morphologyEx(frame_mask, cv2.MORPH_CLOSE, kernel)
 
+    return frame_mask
+
+
+def edge_projections(frame_mask):
+    """Row and column sums of the absolute Sobel edges of a frame mask."""
+    # Create edge maps from the cleaned frame mask. A 3x3 Sobel of a uint8 mask
+    # stays within +-1020, so int16 holds it exactly at a quarter of float64's size
+    sobel_h = cv2.Sobel(frame_mask, cv2.CV_16S, 0, 1, ksize=3)
+    sobel_v = cv2.Sobel(frame_mask, cv2.CV_16S, 1, 0, ksize=3)
+
+    # Get projections
+    h_projection = np.sum(np.abs(sobel_h), axis=1, dtype=np.int64)
+    v_projection = np.sum(np.abs(sobel_v), axis=0, dtype=np.int64)
+
+    return h_projection, v_projection
+
+
+def refine_projection(img, coarse, length, axis, scale, band, threshold):
+    """
+    Upsample a coarse projection to full length, then recompute it exactly at full
+    resolution in bands of +-band coarse pixels around each coarse peak.
+    axis 0 refines the h_projection (rows), axis 1 the v_projection (columns).
+    """
+    projection = np.zeros(length, dtype=np.int64)
+    upsampled = np.repeat(coarse * scale, scale)[:length]
+    projection[: len(upsampled)] = upsampled
+    if coarse.max() <= 0:
+        return projection
+
+    normalized = coarse / coarse.max()
+    inner = normalized[1:-1]
+    peaks = (
+        np.flatnonzero((inner > threshold) & (inner >= normalized[:-2]) & (inner >= normalized[2:]))
+        + 1
+    )
+
+    selected = np.zeros(length, dtype=bool)
+    for peak in peaks:
+        selected[max(0, (peak - band) * scale) : min(length, (peak + band + 1) * scale)] = True
+    edges = np.diff(np.concatenate(([0], selected.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    # Gather every band, with STRIP_CONTEXT lines of context for the closing and
+    # Sobel kernels, into one array so the mask and edges are computed in a single pass
+    context = STRIP_CONTEXT
+    indices = []
+    spans = []
+    offset = 0
+    for start, end in zip(starts, ends):
+        lo, hi = max(0, start - context), min(length, end + context)
+        indices.append(np.arange(lo, hi))
+        spans.append((offset + start - lo, offset + end - lo, start, end))
+        offset += hi - lo
+    strips = np.take(img, np.concatenate(indices), axis=axis)
+
+    h_projection, v_projection = edge_projections(build_frame_mask(strips))
+    refined = h_projection if axis == 0 else v_projection
+    for src_start, src_end, start, end in spans:
+        projection[start:end] = refined[src_start:src_end]
+    return projection
+
+
+def coarse_to_fine_projections(img, scale=2, band=4, threshold=0.1):
+    """
+    Edge projections from a downscaled pyramid level, refined at full resolution
+    only in narrow bands around the coarse peaks. Never builds a full-size mask.
+    """
+    height, width = img.shape[:2]
+    # Nearest sampling keeps the exact frame colour, which averaging would blur
+    coarse_h, coarse_v = edge_projections(build_frame_mask(img[::scale, ::scale]))
+    h_projection = refine_projection(img, coarse_h, height, 0, scale, band, threshold)
+    v_projection = refine_projection(img, coarse_v, width, 1, scale, band, threshold)
+    return h_projection, v_projection
+
+
+class FrameMaskEngine:
+    """
+    Frame masks and edge projections for many images (or strips) in a row.
+    The HSV range and kernel are computed once, and every image is processed
+    in one pool of work buffers that grows to the largest image seen, so
+    consecutive images neither allocate nor page-fault fresh full-size arrays.
+    Results are identical to build_frame_mask and edge_projections.
+    """
+
+    def __init__(self, pixels=0):
+        self.lower_gold, self.upper_gold = frame_hsv_range()
+        self.kernel = np.ones((3, 3), np.uint8)
+        self.capacity = 0
+        self.reserve(pixels)
+
+    def reserve(self, pixels):
+        """Grow the pool to fit an image of this many pixels."""
+        if pixels <= self.capacity:
+            return
+        self.hsv = np.empty(pixels * 3, np.uint8)
+        self.color = np.empty(pixels, np.uint8)
+        self.alpha = np.empty(pixels, np.uint8)
+        self.mask = np.empty(pixels, np.uint8)
+        self.sobel = np.empty(pixels, np.int16)
+        self.edges = np.empty(pixels, np.int16)
+        self.capacity = pixels
+
+    @property
+    def nbytes(self):
+        # hsv 3 + color, alpha, mask 1 each + sobel, edges 2 each
+        return self.capacity * 10
+
+    def frame_mask(self, img):
+        """
+        build_frame_mask of a BGRA array, written into the pool. The mask is
+        overwritten by the next call; copy it to keep it.
+        """
+        height, width = img.shape[:2]
+        pixels = height * width
+        self.reserve(pixels)
+        hsv = self.hsv[: pixels * 3].reshape(height, width, 3)
+        color = self.color[:pixels].reshape(height, width)
+        alpha = self.alpha[:pixels].reshape(height, width)
+        mask = self.mask[:pixels].reshape(height, width)
+
+        # BGR2HSV reads the first three channels of BGRA input directly
+        cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=hsv)
+        cv2.inRange(hsv, self.lower_gold, self.upper_gold, dst=color)
+        # alpha > 127 as 0/255, so a plain AND applies it
+        cv2.extractChannel(img, 3, dst=alpha)
+        cv2.threshold(alpha, 127, 255, cv2.THRESH_BINARY, dst=alpha)
+        cv2.bitwise_and(color, alpha, dst=color)
+        cv2.morphologyEx(color, cv2.MORPH_CLOSE, self.kernel, dst=mask)
+        return mask
+
+    def projections(self, frame_mask, rows=slice(None)):
+        """
+        edge_projections of a frame mask with pooled Sobel buffers. rows limits
+        the sums to those rows; the Sobel still sees the whole mask.
+        """
+        height, width = frame_mask.shape
+        pixels = height * width
+        self.reserve(pixels)
+        sobel = self.sobel[:pixels].reshape(height, width)
+        edges = self.edges[:pixels].reshape(height, width)
+
+        cv2.Sobel(frame_mask, cv2.CV_16S, 0, 1, dst=sobel, ksize=3)
+        np.abs(sobel, out=edges)
+        h_projection = np.sum(edges[rows], axis=1, dtype=np.int64)
+        cv2.Sobel(frame_mask, cv2.CV_16S, 1, 0, dst=sobel, ksize=3)
+        np.abs(sobel, out=edges)
+        v_projection = np.sum(edges[rows], axis=0, dtype=np.int64)
+        return h_projection, v_projection
+
+
+_shared_engine = None
+
+
+def shared_engine():
+    """This process's FrameMaskEngine, so every image it processes reuses one pool."""
+    global _shared_engine
+    if _shared_engine is None:
+        _shared_engine = FrameMaskEngine()
+    return _shared_engine
+
+
+def strip_projections(img, keep_mask=False, strip_rows=STRIP_ROWS, engine=None, release=None):
+    """
+    Edge projections of a BGRA array computed over row strips, in one pass.
+    Each strip is read with STRIP_CONTEXT rows either side, so its rows come
+    out exactly as build_frame_mask and edge_projections compute them on the
+    whole image. Working memory is one strip's worth of engine buffers; with
+    keep_mask the frame mask is also assembled (one byte per pixel) for the
+    contour path. release(start, end) is called with rows no later strip
+    reads again. Returns (h_projection, v_projection, frame_mask or None).
+    """
+    engine = engine or shared_engine()
+    height, width = img.shape[:2]
+    engine.reserve(min(height, strip_rows + 2 * STRIP_CONTEXT) * width)
+    h_projection = np.empty(height, np.int64)
+    v_projection = np.zeros(width, np.int64)
+    frame_mask = np.empty((height, width), np.uint8) if keep_mask else None
+
+    for start in range(0, height, strip_rows):
+        end = min(height, start + strip_rows)
+        lo, hi = max(0, start - STRIP_CONTEXT), min(height, end + STRIP_CONTEXT)
+        mask = engine.frame_mask(img[lo:hi])
+        inner = slice(start - lo, end - lo)
+        if frame_mask is not None:
+            frame_mask[start:end] = mask[inner]
+        h_projection[start:end], strip_v = engine.projections(mask, inner)
+        v_projection += strip_v
+
+        if release is not None:
+            release(lo, max(lo, end - STRIP_CONTEXT))
+    return h_projection, v_projection, frame_mask
+
+
+class MappedPixels:
+    """
+    BGRA pixels memory-mapped read-only from a raw pixel cache file. Pages are
+    read from the page cache on first touch and can be released again.
+    """
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.row_bytes = width * 4
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pixels = np.frombuffer(self.map, np.uint8).reshape(height, width, 4)
+
+    def release(self, start, end):
+        """Drop rows [start, end) from this process's resident set."""
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        page = mmap.PAGESIZE
+        begin = -(-start * self.row_bytes // page) * page
+        stop = end * self.row_bytes // page * page
+        if stop > begin:
+            self.map.madvise(mmap.MADV_DONTNEED, begin, stop - begin)
+
+    def close(self):
+        # The array holds an export of the map, which has to go first
+        self.pixels = None
+        try:
+            self.map.close()
+        except BufferError:
+            # A view is still referenced (e.g. from a traceback); the map is
+            # unmapped when that is collected
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def load_mapped_pixels(image_path, cache_dir=PIXEL_CACHE_DIR):
+    """
+    Map the BGRA pixels of an image from a raw cache file keyed by its content
+    hash, decoding the image and writing the file on first use only.
+    """
+    # Header-only dimensions, so a cache hit never decodes
+    width, height, _ = image_index.read_dimensions(image_path)
+    path = os.path.join(cache_dir, f"{file_digest(image_path)}-{width}x{height}.bgra")
+    if not os.path.exists(path):
+        img = load_image(image_path)
+        if img.shape[:2] != (height, width):
+            raise ValueError(f"Decoded size differs from the header of {image_path}")
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(img).data)
+        os.replace(tmp_path, path)
+        del img
+    return MappedPixels(path, width, height)
+
+
+def prune_pixel_cache(digests, cache_dir=PIXEL_CACHE_DIR):
+    """
+    Delete raw pixel files (and leftover .tmp files) whose content hash is not
+    in digests, so the cache holds at most one file per current source image.
+    Returns (files removed, bytes freed).
+    """
+    if not os.path.isdir(cache_dir):
+        return 0, 0
+    removed = freed = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith(".bgra") and name.split("-", 1)[0] in digests:
+            continue
+        path = os.path.join(cache_dir, name)
+        freed += os.path.getsize(path)
+        os.remove(path)
+        removed += 1
+    return removed, freed
+
+
+def find_frame_bounds(
+    image_path,
+    is_class=False,
+    smooth_contours=False,
+    coarse_scale=1,
+    expected_ratio=None,
+    low_memory=False,
+):
+    if low_memory:
+        with load_mapped_pixels(image_path) as mapped:
+            return find_frame_bounds_in_array(
+                mapped.pixels,
+                is_class,
+                smooth_contours,
+                source=image_path,
+                expected_ratio=expected_ratio,
+                strip_rows=STRIP_ROWS,
+                release=mapped.release,
+            )
+    img = load_image(image_path)
+    return find_frame_bounds_in_array(
+        img,
+        is_class,
+        smooth_contours,
+        source=image_path,
+        coarse_scale=coarse_scale,
+        expected_ratio=expected_ratio,
+    )
+
+
+def find_frame_bounds_in_array(
+    img,
+    is_class=False,
+    smooth_contours=False,
+    source="image",
+    coarse_scale=1,
+    expected_ratio=None,
+    strip_rows=None,
+    release=None,
+    engine=None,
+):
+    """
+    Find frame bounds in an already decoded BGRA array.
+    With coarse_scale > 1 the edge projections are found coarse-to-fine; the
+    smooth_contours path needs the whole mask and always runs at full resolution.
+    expected_ratio (frame height / width, e.g. from image_index) replaces the
+    class/subclass constants when a missing edge has to be inferred.
+    strip_rows selects the low-memory mode: the mask and projections come from
+    strip_projections (release is passed on) and coarse_scale is ignored. The
+    bounds are identical to the full-image path. With an engine (a
+    FrameMaskEngine) the full-resolution mask and projections are computed in
+    its buffer pool.
+    """
+    if img.ndim < 3 or img.shape[2] < 4:
+        raise ValueError(f"Could not load image with alpha: {source}")
+
+    height, width = img.shape[:2]
+
+    frame_mask = None
+    projections = None
+    if strip_rows:
+        with instrument.span("strips", strip_rows=strip_rows):
+            h_projection, v_projection, frame_mask = strip_projections(
+                img, smooth_contours, strip_rows, engine, release
+            )
+        projections = h_projection, v_projection
     if smooth_contours:
-        smoothed_bounds = smooth_to_rectangle(frame_mask)
+        if frame_mask is None:
+            with instrument.span("mask"):
+                frame_mask = engine.frame_mask(img) if engine else build_frame_mask(img)
+        with instrument.span("contours"):
+            smoothed_bounds = smooth_to_rectangle(frame_mask)
         if smoothed_bounds:
             # Add small padding
             padding = 2
@@ -73,23 +457,46 @@ def find_frame_bounds(image_path, is_class=False, smooth_contours=False):
                 ),
             }
 
-    # Create edge maps from the cleaned frame mask
-    sobel_h = cv2.Sobel(frame_mask, cv2.CV_64F, 0, 1, ksize=3)
-    sobel_v = cv2.Sobel(frame_mask, cv2.CV_64F, 1, 0, ksize=3)
+    if projections is not None:
+        h_projection, v_projection = projections
+    elif frame_mask is None and coarse_scale > 1:
+        with instrument.span("projections", coarse_scale=coarse_scale):
+            h_projection, v_projection = coarse_to_fine_projections(img, coarse_scale)
+    else:
+        if frame_mask is None:
+            with instrument.span("mask"):
+                frame_mask = engine.frame_mask(img) if engine else build_frame_mask(img)
+        with instrument.span("projections"):
+            if engine:
+                h_projection, v_projection = engine.projections(frame_mask)
+            else:
+                h_projection, v_projection = edge_projections(frame_mask)
+    with instrument.span("peaks"):
+        return bounds_from_projections(
+            h_projection, v_projection, width, height, is_class, source, expected_ratio
+        )
 
-    # Get projections
-    h_projection = np.sum(np.abs(sobel_h), axis=1)
-    v_projection = np.sum(np.abs(sobel_v), axis=0)
 
+def bounds_from_projections(
+    h_projection,
+    v_projection,
+    width,
+    height,
+    is_class=False,
+    source="image",
+    expected_ratio=None,
+):
+    """Locate the four frame edges from the edge projections, inferring a missing one."""
     # Find peaks in projections - these are the likely positions of frame edges
     h_peaks = find_significant_peaks(h_projection, min_height=width * 0.3)
     v_peaks = find_significant_peaks(v_projection, min_height=height * 0.3)
 
-    # Expected aspect ratio
-    if is_class:
-        expected_ratio = 1.57 / 1.16  # Exact class ratio
-    else:
-        expected_ratio = 1.65 / 0.55  # Exact subclass ratio
+    # Expected aspect ratio, per image when the caller knows it
+    if expected_ratio is None:
+        if is_class:
+            expected_ratio = 1.57 / 1.16  # Exact class ratio
+        else:
+            expected_ratio = 1.65 / 0.55  # Exact subclass ratio
 
     # If we have at least 3 edges (2 horizontal + 1 vertical or 1 horizontal + 2 vertical)
     if len(h_peaks) >= 2 and len(v_peaks) >= 1:
@@ -150,7 +557,7 @@ def find_frame_bounds(image_path, is_class=False, smooth_contours=False):
 
     # If we haven't found at least 3 edges, raise an error
     elif len(h_peaks) + len(v_peaks) < 3:
-        raise ValueError(f"Could not find enough frame edges in {image_path}")
+        raise ValueError(f"Could not find enough frame edges in {source}")
 
     # If we have exactly 3 edges total, try to infer the 4th
     else:
@@ -248,6 +655,13 @@ def smooth_to_rectangle(mask):
     }
 
 
+def local_maxima(values, threshold):
+    """Indices i (excluding the ends) where values[i] > threshold and is a strict local maximum."""
+    inner = values[1:-1]
+    mask = (inner > threshold) & (inner > values[:-2]) & (inner > values[2:])
+    return np.flatnonzero(mask) + 1
+
+
 def find_significant_peaks(projection, min_height):
     """
     Find significant peaks in a projection array, including clusters of smaller peaks.
@@ -263,160 +677,456 @@ def find_significant_peaks(projection, min_height):
     smoothed = np.convolve(normalized, np.ones(window_size) / window_size, mode="same")
 
     # First find all peaks, including smaller ones (2-8% of image size)
-    all_peaks = []
     small_threshold = 0.1  # Capture even small peaks
-
-    for i in range(1, len(smoothed) - 1):
-        if (
-            smoothed[i] > small_threshold
-            and smoothed[i] > smoothed[i - 1]
-            and smoothed[i] > smoothed[i + 1]
-        ):
-            all_peaks.append((i, smoothed[i]))  # Store index and magnitude
+    positions = local_maxima(smoothed, small_threshold)
 
     # No peaks found
-    if not all_peaks:
+    if len(positions) == 0:
         return []
+    heights = smoothed[positions]
 
     # Group peaks into clusters with adaptive window
-    clusters = []
     min_dist = max(10, int(len(projection) * 0.01))  # Dynamic minimum distance
     max_dist = max(20, int(len(projection) * 0.03))  # Dynamic maximum distance
-    current_cluster = [all_peaks[0]]
 
-    # Calculate gradient continuity scores
-    grad_scores = np.gradient(smoothed)
+    # Gradient continuity between two positions is the mean |gradient| over
+    # [start, end), taken from a prefix sum instead of slicing per pair
+    grad = np.abs(np.gradient(smoothed))
+    grad_prefix = np.concatenate(([0.0], np.cumsum(grad)))
+
+    starts = positions[:-1]
+    ends = positions[1:]
+    peak_distance = ends - starts
+    grad_continuity = (grad_prefix[ends] - grad_prefix[starts]) / peak_distance
+
+    # The prefix sum and np.mean round differently in the last bits. On plateaus
+    # the exact mean often sits on the threshold, so those pairs are recomputed
+    # the way the original did
+    for k in np.flatnonzero(np.abs(grad_continuity - 0.1) < 1e-9):
+        grad_continuity[k] = np.mean(grad[starts[k] : ends[k]])
+
+    # Adaptive clustering based on distance and gradient continuity
+    joins = (peak_distance < max_dist) & (
+        (peak_distance < min_dist) | (grad_continuity > 0.1)
+    )
+    breaks = np.flatnonzero(~joins)
+    cluster_starts = np.concatenate(([0], breaks + 1))
+    cluster_counts = np.diff(np.concatenate((cluster_starts, [len(positions)])))
+
+    # A closed cluster is scored with the continuity of the gap that ended it; the
+    # last cluster uses the continuity across its own span (NaN for a single peak,
+    # which is kept for parity with the original scoring). Equal-looking clusters
+    # on plateaus tie exactly, so the few per-cluster means are taken with
+    # np.mean like the original rather than from the prefix sum
+    last_start = positions[cluster_starts[-1]]
+    last_end = positions[-1]
+    if last_end > last_start:
+        last_continuity = np.mean(grad[last_start:last_end])
+    else:
+        last_continuity = np.nan
+    cluster_continuity = np.array(
+        [np.mean(grad[starts[k] : ends[k]]) for k in breaks] + [last_continuity]
+    )
+    cluster_scores = np.add.reduceat(heights, cluster_starts) * (1 + cluster_continuity)
 
-    for i in range(1, len(all_peaks)):
-        current_peak = all_peaks[i]
-        last_peak = all_peaks[i - 1]
-        peak_distance = current_peak[0] - last_peak[0]
+    # Cluster spread
+    cluster_ids = np.repeat(np.arange(len(cluster_starts)), cluster_counts)
+    means = np.add.reduceat(positions, cluster_starts) / cluster_counts
+    spreads = np.sqrt(
+        np.add.reduceat((positions - means[cluster_ids]) ** 2, cluster_starts) / cluster_counts
+    )
 
-        # Calculate gradient continuity score
-        region_start = max(0, last_peak[0])
-        region_end = min(len(grad_scores), current_peak[0])
-        grad_continuity = np.mean(np.abs(grad_scores[region_start:region_end]))
+    # Sort clusters by score, keep only tight clusters and sort again. Equal
+    # scores keep cluster (position) order through the explicit index key, as
+    # the original's stable sort did; the handful of clusters is ordered with
+    # Python's sort so NaN scores land exactly where they always have
+    order = sorted(range(len(cluster_starts)), key=lambda k: (-cluster_scores[k], k))
+    scored_clusters = [(k, cluster_scores[k]) for k in order if spreads[k] < max_dist]
+    scored_clusters.sort(key=lambda x: (-x[1], x[0]))
 
-        # Adaptive clustering based on distance and gradient continuity
-        if peak_distance < max_dist and (peak_distance < min_dist or grad_continuity > 0.1):
-            # Peaks are close or have strong gradient continuity
-            current_cluster.append(current_peak)
-        else:
-            if len(current_cluster) > 0:
-                # Score cluster based on peak heights and gradient support
-                cluster_score = sum(p[1] for p in current_cluster) * (1 + grad_continuity)
-                clusters.append((current_cluster, cluster_score))
-            current_cluster = [current_peak]
-
-    # Add the last cluster with scoring
-    if current_cluster:
-        region_start = max(0, current_cluster[0][0])
-        region_end = min(len(grad_scores), current_cluster[-1][0])
-        grad_continuity = np.mean(np.abs(grad_scores[region_start:region_end]))
-        cluster_score = sum(p[1] for p in current_cluster) * (1 + grad_continuity)
-        clusters.append((current_cluster, cluster_score))
-
-    # Sort clusters by score and extract positions
-    clusters.sort(key=lambda x: x[1], reverse=True)
-    scored_clusters = []
-
-    for cluster, score in clusters:
-        # Weight peaks by their height and position consistency
-        weights = [p[1] for p in cluster]
-        positions = [p[0] for p in cluster]
-        avg_pos = int(np.average(positions, weights=weights))
-
-        # Calculate cluster spread
-        spread = np.std(positions)
-        if spread < max_dist:  # Only consider tight clusters
-            scored_clusters.append((avg_pos, score))
-
-    # Sort by score
-    scored_clusters.sort(key=lambda x: x[1], reverse=True)
-
-    # Get positions of best clusters
-    peak_positions = [pos for pos, _ in scored_clusters[:4]]  # Take up to 4 best clusters
+    # Get positions of best clusters, weighted like the original's np.average
+    peak_positions = []
+    for k, _ in scored_clusters[:4]:  # Take up to 4 best clusters
+        members = slice(cluster_starts[k], cluster_starts[k] + cluster_counts[k])
+        peak_positions.append(int(np.average(positions[members], weights=heights[members])))
 
     # If we found at least the required peaks, return them, otherwise use the original method
     if len(peak_positions) >= 2:
         return sorted(peak_positions)
     else:
         # Fall back to original method for robustness
-        strong_peaks = []
-        for i in range(1, len(smoothed) - 1):
-            if (
-                smoothed[i] > 0.5
-                and smoothed[i] > smoothed[i - 1]
-                and smoothed[i] > smoothed[i + 1]
-            ):
-                strong_peaks.append(i)
-        return strong_peaks
-
-
-def process_image(image_path, is_class=False, smooth_contours=False):
+        return local_maxima(smoothed, 0.5).tolist()
+
+
+def crop_to_bounds(img, bounds):
+    """Crop an array to bounds as a view, without copying pixels."""
+    return img[
+        bounds["y"] : bounds["y"] + bounds["height"],
+        bounds["x"] : bounds["x"] + bounds["width"],
+    ]
+
+
+def clipped_path(image_path, output_dir="processed"):
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(output_dir, f"{name}_clipped.png")
+
+
+def crop_key(content_hash, bounds):
+    """Identifies a crop by the source content and the bounds it was cut with."""
+    return json.dumps({"sha256": content_hash, "bounds": bounds}, sort_keys=True)
+
+
+def open_crop_record():
+    """ResultCache mapping each crop path to the crop_key it was written with."""
+    return ResultCache(CROP_RECORD_PATH, CROP_RECORD_VERSION)
+
+
+def crop_is_current(crops, image_path, content_hash, bounds):
+    """
+    True if the crop of image_path on disk was cut from this content with these
+    bounds. A crop merely existing is not enough: it may come from other
+    settings or from an earlier version of the image.
+    """
+    path = clipped_path(image_path)
+    return os.path.exists(path) and crops.entries.get(path) == crop_key(content_hash, bounds)
+
+
+def record_crop(crops, image_path, content_hash, bounds):
+    """Note the crop just written for image_path, or forget it if there is none."""
+    if bounds:
+        crops.put(clipped_path(image_path), crop_key(content_hash, bounds))
+    else:
+        crops.discard(clipped_path(image_path))
+
+
+def frame_bounds_params(is_class, smooth_contours, coarse_scale, expected_ratio=None):
+    """Everything besides the pixels that the bounds depend on, for cache keys."""
+    params = {
+        "is_class": is_class,
+        "smooth_contours": smooth_contours,
+        "coarse_scale": coarse_scale,
+        "frame_color_bgr": list(FRAME_COLOR_BGR),
+        "hsv_ranges": [HUE_RANGE, SAT_RANGE, VAL_RANGE],
+    }
+    # Only present when set, so keys of the constant-ratio path stay unchanged
+    if expected_ratio is not None:
+        params["expected_ratio"] = expected_ratio
+    return params
+
+
+def process_image(
+    image_path,
+    is_class=False,
+    smooth_contours=False,
+    coarse_scale=1,
+    expected_ratio=None,
+    low_memory=False,
+):
     try:
-        # Open image with PIL
-        img = Image.open(image_path)
+        with instrument.span("process_image", image=image_path):
+            if low_memory:
+                return process_image_mapped(
+                    image_path, is_class, smooth_contours, expected_ratio
+                )
+            return process_image_stages(
+                image_path, is_class, smooth_contours, coarse_scale, expected_ratio
+            )
+    except Exception as e:
+        print(f"Error processing {image_path}: {str(e)}")
+        return None
+
 
+def process_image_stages(
+    image_path,
+    is_class,
+    smooth_contours,
+    coarse_scale,
+    expected_ratio=None,
+    img=None,
+    strip_rows=None,
+    release=None,
+):
+    """Decode, detect, crop and encode one image, one span per stage."""
+    if img is None:
+        with instrument.span("decode") as span:
+            # Decode once and share the pixels between detection and cropping
+            img = load_image(image_path)
+            span.set(bytes=img.nbytes)
+
+    with instrument.span("detect"):
         # Find frame bounds with optional smoothing
-        bounds = find_frame_bounds(image_path, is_class, smooth_contours)
+        bounds = find_frame_bounds_in_array(
+            img,
+            is_class,
+            smooth_contours,
+            source=image_path,
+            coarse_scale=coarse_scale,
+            expected_ratio=expected_ratio,
+            strip_rows=strip_rows,
+            release=release,
+            engine=shared_engine(),
+        )
 
-        # Create output directory
-        output_dir = "processed"
-        os.makedirs(output_dir, exist_ok=True)
+    # Create output directory
+    output_path = clipped_path(image_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-        basename = os.path.basename(image_path)
-        name = os.path.splitext(basename)[0]
+    basename = os.path.basename(image_path)
 
+    with instrument.span("crop") as span:
         # Create clipped version
-        clipped = img.crop(
-            (
-                bounds["x"],
-                bounds["y"],
-                bounds["x"] + bounds["width"],
-                bounds["y"] + bounds["height"],
-            )
-        )
+        clipped = crop_to_bounds(img, bounds)
+        span.set(bytes=clipped.nbytes)
 
+    with instrument.span("encode") as span:
         # Save processed images
-        clipped.save(os.path.join(output_dir, f"{name}_clipped.png"))
-        print(f"Successfully processed: {basename} - bounds: {bounds}")
-        return bounds
+        if not cv2.imwrite(output_path, clipped):
+            raise ValueError(f"Could not write clipped image for {basename}")
+        span.set(bytes=os.path.getsize(output_path))
+    print(f"Successfully processed: {basename} - bounds: {bounds}")
+    return bounds
+
+
+def process_image_mapped(image_path, is_class, smooth_contours, expected_ratio=None):
+    """
+    process_image_stages in low-memory mode: the pixels are mapped from the raw
+    pixel cache and detection runs in strips, releasing rows as it goes. The
+    encoder then reads only the cropped rows of the mapping.
+    """
+    with instrument.span("map") as span:
+        mapped = load_mapped_pixels(image_path)
+        span.set(bytes=mapped.pixels.nbytes)
+    with mapped:
+        return process_image_stages(
+            image_path,
+            is_class,
+            smooth_contours,
+            1,
+            expected_ratio,
+            img=mapped.pixels,
+            strip_rows=STRIP_ROWS,
+            release=mapped.release,
+        )
 
-    except Exception as e:
-        print(f"Error processing {image_path}: {str(e)}")
-        return None
 
+def list_image_tasks():
+    """Collect (folder, image_file, is_class) tasks in a deterministic order."""
+    tasks = []
+    for folder, is_class in (("classes", True), ("subclasses", False)):
+        if os.path.exists(folder):
+            for image_file in sorted(os.listdir(folder)):
+                if image_file.endswith((".png", ".webp")):
+                    tasks.append((folder, image_file, is_class))
+    return tasks
 
-def process_all_images(smooth_contours=False):
-    bounds_data = {}
-
-    # Process classes
-    if os.path.exists("classes"):
-        bounds_data["classes"] = {}
-        for image_file in os.listdir("classes"):
-            if image_file.endswith((".png", ".webp")):
-                image_path = os.path.join("classes", image_file)
-                bounds = process_image(image_path, is_class=True, smooth_contours=smooth_contours)
-                if bounds:
-                    bounds_data["classes"][image_file] = bounds
-
-    # Process subclasses
-    if os.path.exists("subclasses"):
-        bounds_data["subclasses"] = {}
-        for image_file in os.listdir("subclasses"):
-            if image_file.endswith((".png", ".webp")):
-                image_path = os.path.join("subclasses", image_file)
-                bounds = process_image(image_path, is_class=False, smooth_contours=smooth_contours)
-                if bounds:
-                    bounds_data["subclasses"][image_file] = bounds
+
+def init_worker():
+    """
+    Pool initializer: one OpenCV thread per worker process. Otherwise every
+    worker starts OpenCV's own thread pool and the processes oversubscribe
+    the cores they were meant to share.
+    """
+    cv2.setNumThreads(1)
+
+
+def process_task(
+    task, smooth_contours=False, coarse_scale=1, expected_ratio=None, low_memory=False
+):
+    folder, image_file, is_class = task
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    bounds = process_image(
+        os.path.join(folder, image_file),
+        is_class=is_class,
+        smooth_contours=smooth_contours,
+        coarse_scale=coarse_scale,
+        expected_ratio=expected_ratio,
+        low_memory=low_memory,
+    )
+    return {
+        "folder": folder,
+        "image": image_file,
+        "bounds": bounds,
+        "elapsed": time.perf_counter() - start,
+        "cpu": time.process_time() - cpu_start,
+    }
+
+
+def process_all_images(
+    smooth_contours=False,
+    jobs=1,
+    coarse_scale=1,
+    use_cache=True,
+    ratio_index=None,
+    low_memory=False,
+):
+    """
+    Process every image in classes/ and subclasses/.
+    With jobs > 1 the images are spread across a process pool; results are
+    gathered in the same order as the serial path. With use_cache, images whose
+    content and parameters are unchanged (and whose crop exists) are skipped.
+    ratio_index (the images mapping of an image_index file) supplies per-image
+    expected frame ratios for class art; subclass art and images missing from
+    it use the constants.
+    low_memory maps pixels from the raw pixel cache and detects in strips; the
+    bounds (and cache keys) are the same as the full-image path's. Cache files
+    of images that no longer exist or have changed are pruned afterwards.
+    """
+    tasks = list_image_tasks()
+    # Digests are needed even without the cache, to record what each crop was cut from
+    digests = [file_digest(os.path.join(folder, image_file)) for folder, image_file, _ in tasks]
+    ratios = [
+        image_index.expected_ratio(ratio_index, os.path.join(folder, image_file), is_class)
+        if ratio_index
+        else None
+        for folder, image_file, is_class in tasks
+    ]
+    bounds_data = {folder: {} for folder in ("classes", "subclasses") if os.path.exists(folder)}
+    cache = (
+        ResultCache(os.path.join(CACHE_DIR, "frame_bounds.json"), FRAME_BOUNDS_VERSION)
+        if use_cache
+        else None
+    )
+    crops = open_crop_record()
+
+    start = time.perf_counter()
+    results = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    pending = []
+    for i, (folder, image_file, is_class) in enumerate(tasks):
+        if cache is not None:
+            image_path = os.path.join(folder, image_file)
+            keys[i] = cache.key(
+                digests[i],
+                frame_bounds_params(is_class, smooth_contours, coarse_scale, ratios[i]),
+            )
+            # A crop that is missing or was cut under other settings or from
+            # other content has to be regenerated, so it counts as a miss
+            cached = cache.entries.get(keys[i])
+            if cached is not None and crop_is_current(crops, image_path, digests[i], cached):
+                cache.hits += 1
+                results[i] = {
+                    "folder": folder,
+                    "image": image_file,
+                    "bounds": cached,
+                    "elapsed": 0.0,
+                    "cpu": 0.0,
+                }
+                continue
+            cache.misses += 1
+        pending.append(i)
+
+    pending_tasks = [tasks[i] for i in pending]
+    pooled = jobs > 1 and len(pending_tasks) > 1
+    if pooled:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+            computed = list(
+                pool.map(
+                    process_task,
+                    pending_tasks,
+                    [smooth_contours] * len(pending_tasks),
+                    [coarse_scale] * len(pending_tasks),
+                    [ratios[i] for i in pending],
+                    [low_memory] * len(pending_tasks),
+                    chunksize=1,
+                )
+            )
+    else:
+        computed = [
+            process_task(tasks[i], smooth_contours, coarse_scale, ratios[i], low_memory)
+            for i in pending
+        ]
+    for i, result in zip(pending, computed):
+        results[i] = result
+        folder, image_file, _ = tasks[i]
+        record_crop(crops, os.path.join(folder, image_file), digests[i], result["bounds"])
+        if cache is not None and result["bounds"]:
+            cache.put(keys[i], result["bounds"])
+    wall_time = time.perf_counter() - start
+
+    crops.save()
+    if cache is not None:
+        cache.save()
+        print(cache.summary())
+    if low_memory:
+        removed, freed = prune_pixel_cache(set(digests))
+        if removed:
+            print(f"Pruned {removed} stale pixel cache file(s), {freed / 1e6:.0f} MB")
+
+    for result in results:
+        print(f"  {result['folder']}/{result['image']}: {result['elapsed']:.2f}s")
+        if result["bounds"]:
+            bounds_data[result["folder"]][result["image"]] = result["bounds"]
+
+    # Serial reference: what each image costs on its own. Run serially that is
+    # its wall time. Pool workers run OpenCV on one thread, so there its CPU time
+    # is that cost without the waiting for cores that inflates wall time when
+    # jobs exceed them. It is a one-thread reference: a --jobs 1 run lets OpenCV
+    # use more cores and can beat it
+    serial_time = sum(result["cpu"] if pooled else result["elapsed"] for result in results)
+    speedup = serial_time / wall_time if wall_time > 0 else 0.0
+    print(
+        f"Processed {len(results)} images in {wall_time:.2f}s with {jobs} job(s); "
+        f"serial estimate {serial_time:.2f}s, speedup {speedup:.2f}x"
+    )
 
     # # Save bounds data
     # with open("image_bounds.json", "w") as f:
     #     json.dump(bounds_data, f, indent=2)
 
     print("Processing complete. Check image_bounds.json for results.")
+    return bounds_data
 
 
 if __name__ == "__main__":
-    process_all_images(smooth_contours=True)
+    parser = argparse.ArgumentParser(description="Detect frame bounds and crop class/subclass art")
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="number of worker processes (default: 1, serial)"
+    )
+    parser.add_argument(
+        "--coarse-scale",
+        type=int,
+        choices=COARSE_SCALES,
+        default=1,
+        help="find edges on a 1/N pyramid level and refine them at full resolution "
+        "(projection path only; default: 1, full resolution)",
+    )
+    parser.add_argument(
+        "--no-smooth", action="store_true", help="use the projection path instead of contours"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="recompute every image, ignoring the cache"
+    )
+    parser.add_argument(
+        "--ratio-index",
+        nargs="?",
+        const=image_index.INDEX_PATH,
+        metavar="PATH",
+        help="infer missing edges of class frames from per-image ratios in an image_index.py "
+        f"index (default path: {image_index.INDEX_PATH}; built if missing)",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help=f"detect in {STRIP_ROWS}-row strips over pixels memory-mapped from a raw cache "
+        f"in {PIXEL_CACHE_DIR} (4 bytes per pixel on disk); bounds are unchanged",
+    )
+    args = parser.parse_args()
+
+    ratio_index = None
+    if args.ratio_index:
+        ratio_index = image_index.load_index(args.ratio_index)
+        if not ratio_index:
+            ratio_index = image_index.scan_images()
+            image_index.write_index(ratio_index, args.ratio_index)
+            print(f"Built {args.ratio_index}")
+
+    with instrument.profiled(), instrument.span("process_all_images"):
+        process_all_images(
+            smooth_contours=not args.no_smooth,
+            jobs=args.jobs,
+            coarse_scale=args.coarse_scale,
+            use_cache=not args.no_cache,
+            ratio_index=ratio_index,
+            low_memory=args.low_memory,
+        )
@@ -0,0 +1,74 @@
+import os
+import json
+import hashlib
+
+
+CACHE_DIR = ".cache"
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """sha256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent JSON cache of per-image results, keyed by content hash plus the
+    algorithm parameters. Bumping version discards every stored entry.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == version:
+                self.entries = data.get("entries", {})
+            else:
+                print(f"Discarding {path}: algorithm version changed")
+                self.dirty = True
+
+    def key(self, content_hash, params):
+        payload = json.dumps({"sha256": content_hash, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.entries.get(key) != value:
+            self.entries[key] = value
+            self.dirty = True
+
+    def discard(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the cache atomically, and only if something changed."""
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return f"Cache {self.path}: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
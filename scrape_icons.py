@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 import os
-import requests
+import sys
 from urllib.parse import urlparse
-from PIL import Image
-from io import BytesIO
 import time
 import random
 
+import instrument
+from async_fetch import AsyncDownloader, FetchError
+from downloader import Downloader, Manifest
+
 
 def create_directory(directory):
     """Create directory if it doesn't exist"""
@@ -60,26 +62,23 @@ def get_filename_from_url(url):
     return f"{name}.png"
 
 
-def download_and_save(url, save_path):
+def download_and_save(url, save_path, downloader=None):
     """Download image from URL and save as PNG"""
+    if downloader is None:
+        with Downloader(manifest=Manifest()) as downloader:
+            return download_and_save(url, save_path, downloader)
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers, stream=True, timeout=10)
-        response.raise_for_status()
-
-        # Use PIL to open the image and save as PNG
-        img = Image.open(BytesIO(response.content))
-        img.save(save_path, "PNG")
+        with instrument.span("download", image=url) as span:
+            result = downloader.download(url, save_path)
+            span.set(bytes=result["bytes"])
         print(f"Successfully downloaded and saved: {save_path}")
         return True
-    except Exception as e:
+    except (FetchError, OSError, ValueError) as e:
         print(f"Error downloading {url}: {e}")
         return False
 
 
-def main():
+def main(use_async=False):
     # Define paths
     input_file = "urls_icons.txt"
     icons_dir = "icons"
@@ -98,22 +97,21 @@ def main():
 
     print(f"Found {len(urls)} URLs to download")
 
-    # Download and save each image
-    successful_downloads = 0
-    for url in urls:
-        filename = get_filename_from_url(url)
-        save_path = os.path.join(icons_dir, filename)
-
-        # Add a small delay to be nice to the server
-        time.sleep(0.5)
-
-        if download_and_save(url, save_path):
-            successful_downloads += 1
+    # Download all images over a shared connection pool; the per-host rate limit
+    # replaces the old fixed delay between requests
+    jobs = [(url, os.path.join(icons_dir, get_filename_from_url(url))) for url in urls]
+    # use_async (--async) opts into the asyncio engine with retries and a deadline
+    engine = AsyncDownloader if use_async else Downloader
+    with engine(per_host=2, rate=2.0, manifest=Manifest()) as downloader:
+        with instrument.span("download_all", image=input_file) as span:
+            summary = downloader.download_all(jobs)
+            span.set(bytes=summary["bytes"], files=summary["total"])
 
     print(
-        f"Download complete. Successfully downloaded {successful_downloads} out of {len(urls)} images."
+        f"Download complete. Successfully downloaded {summary['succeeded']} out of {len(urls)} images."
     )
 
 
 if __name__ == "__main__":
-    main()
+    with instrument.profiled():
+        main(use_async="--async" in sys.argv[1:])
@@ -117,6 +117,71 @@ document.addEventListener("DOMContentLoaded", function() {
 			console.warn("Could not load image offset configuration:", error);
 		});
 
+	let imageDerivatives = {}; // Responsive variants per source image (build_derivatives.py)
+
+	// Load the responsive image manifest before the first images are created, so
+	// even the initial cards request the small variants
+	const derivativesLoaded = fetch('image-derivatives.json')
+		.then(response => response.ok ? response.json() : {})
+		.then(data => {
+			imageDerivatives = data;
+			console.log("Loaded image derivatives manifest");
+		})
+		.catch(error => {
+			console.warn("Could not load image derivatives manifest:", error);
+		});
+
+	function applyResponsiveSources(img, path) {
+		const entry = imageDerivatives[path];
+		const variants = entry ? (entry.sources.webp || []) : [];
+		if (variants.length === 0) {
+			return;
+		}
+		// The original stays the largest candidate; src is left untouched so it
+		// remains the fallback and offsets keep working on its filename
+		const candidates = variants.map(variant => `${encodeURI(variant.src)} ${variant.width}w`);
+		candidates.push(`${encodeURI(path)} ${entry.width}w`);
+		img.srcset = candidates.join(', ');
+		// Images are shown about 81vh tall (90% of a 90vh viewer), width follows the aspect ratio
+		img.sizes = `${(81 * entry.width / entry.height).toFixed(1)}vh`;
+	}
+
+	let atlasData = {}; // Sprite atlases for class previews and icons (build_atlas.py)
+
+	const atlasLoaded = fetch('atlas.json')
+		.then(response => response.ok ? response.json() : {})
+		.then(data => {
+			atlasData = data;
+			console.log("Loaded sprite atlas");
+		})
+		.catch(error => {
+			console.warn("Could not load sprite atlas:", error);
+		});
+
+	// Build an element that shows one sprite of an atlas group, or null if the
+	// image is not in the atlas
+	function createAtlasSprite(group, path, label) {
+		const entry = atlasData[group];
+		const sprite = entry ? entry.sprites[path] : undefined;
+		if (!sprite) {
+			return null;
+		}
+		const atlas = entry.atlases[sprite.atlas];
+		const element = document.createElement('div');
+		element.className = 'atlas-sprite';
+		element.setAttribute('role', 'img');
+		element.setAttribute('aria-label', label);
+		element.style.aspectRatio = `${sprite.width} / ${sprite.height}`;
+		element.style.backgroundImage = `url("${encodeURI(atlas.src)}")`;
+		element.style.backgroundSize =
+			`${atlas.width / sprite.width * 100}% ${atlas.height / sprite.height * 100}%`;
+		// Percentage positions are relative to the space left over by the sprite
+		const posX = atlas.width === sprite.width ? 0 : sprite.x / (atlas.width - sprite.width) * 100;
+		const posY = atlas.height === sprite.height ? 0 : sprite.y / (atlas.height - sprite.height) * 100;
+		element.style.backgroundPosition = `${posX}% ${posY}%`;
+		return element;
+	}
+
 	function getImageOffset(filename) {
 		// Extract the filename without extension
 		const basename = filename.replace(/\.[^/.]+$/, "");
@@ -179,6 +244,7 @@ document.addEventListener("DOMContentLoaded", function() {
 		
 		const img = document.createElement('img');
 		img.src = `classes/${className}.png`;
+		applyResponsiveSources(img, `classes/${className}.png`);
 		img.alt = className;
 		
 		const caption = document.createElement('div');
@@ -197,8 +263,16 @@ document.addEventListener("DOMContentLoaded", function() {
 		const item = document.createElement('div');
 		item.className = `preview-item ${direction}`;
 		
+		// Previews are drawn from the shared atlas when it has them
+		const sprite = createAtlasSprite('classes', `classes/${className}.png`, `Preview of ${className}`);
+		if (sprite) {
+			item.appendChild(sprite);
+			return item;
+		}
+		
 		const img = document.createElement('img');
 		img.src = `classes/${className}.png`;
+		applyResponsiveSources(img, `classes/${className}.png`);
 		img.alt = `Preview of ${className}`;
 		
 		item.appendChild(img);
@@ -345,8 +419,12 @@ document.addEventListener("DOMContentLoaded", function() {
 			const imagePath = getSubclassImagePath(subclass);
 			if (imagePath) {
 				img.src = imagePath;
+				applyResponsiveSources(img, imagePath);
 				img.onerror = () => {
 					console.error(`Failed to load image: ${imagePath}`);
+					// A srcset candidate would win over the fallback src
+					img.removeAttribute('srcset');
+					img.removeAttribute('sizes');
 					// Try fallback options if the mapped filename doesn't work
 					const fallbacks = formatSubclassFilename(subclass, classes[currentClassIndex]);
 					let fallbackIndex = 0;
@@ -486,6 +564,6 @@ document.addEventListener("DOMContentLoaded", function() {
 		}, 10);
 	}
 
-	// Initialize with first class
-	showClass(0);
+	// Initialize with first class once the derivatives manifest and atlas are known
+	Promise.all([derivativesLoaded, atlasLoaded]).then(() => showClass(0));
 });
@@ -1,18 +1,465 @@
+"""
+Static file server for the site.
+
+Serves the working directory over HTTP/1.1 with one thread per connection,
+keep-alive, ETag/Last-Modified validation (304 responses), single byte-range
+requests and a per-path Cache-Control policy matching the one the deploy
+workflow emulates with a service worker.
+
+Large files are sent with sendfile(2) straight from the page cache; small hot
+files (css, js, json, icons) are served from a bounded LRU of memory-mapped
+files that is invalidated when a file's mtime or size changes.
+
+Text assets are served from the .br/.gz siblings written by
+build_compressed.py when the client accepts them; nothing is compressed on
+the fly.
+"""
+import io
+import os
+import re
+import mmap
+import argparse
+import threading
 import http.server
-import socketserver
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
 
 PORT = 8002
 
-Handler = http.server.SimpleHTTPRequestHandler
-Handler.extensions_map.update(
-    {
+# (pattern, Cache-Control) pairs, first match wins. Patterns starting with "/"
+# match a path prefix, anything else matches the end of the path.
+CACHE_POLICIES = [
+    ("/classes/", "public, max-age=604800, immutable"),
+    ("/subclasses/", "public, max-age=604800, immutable"),
+    ("/derivatives/", "public, max-age=604800, immutable"),
+    ("/atlas/", "public, max-age=604800, immutable"),
+    (".css", "public, max-age=86400"),
+    (".js", "public, max-age=86400"),
+    ("image-offsets.json", "public, max-age=86400"),
+]
+
+# Everything else may be cached but must be revalidated (cheap with ETags)
+DEFAULT_CACHE_CONTROL = "no-cache"
+
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_TIMEOUT = 15
+
+# Files at least this large are sent with sendfile(2) instead of read/write
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# Hot-file cache: total mapped bytes and the largest file worth caching
+HOT_CACHE_BYTES = 32 * 1024 * 1024
+HOT_CACHE_MAX_FILE = 256 * 1024
+
+# (Content-Encoding, sibling suffix) in order of preference
+PRECOMPRESSED = [("br", ".br"), ("gzip", ".gz")]
+PRECOMPRESSED_TYPES = {".html", ".css", ".js", ".json"}
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def cache_control_for(path, policies=CACHE_POLICIES):
+    for pattern, value in policies:
+        if pattern.startswith("/"):
+            if path.startswith(pattern):
+                return value
+        elif path.endswith(pattern):
+            return value
+    return DEFAULT_CACHE_CONTROL
+
+
+def parse_policy(text):
+    """Parse a PATTERN=CACHE-CONTROL command line argument."""
+    pattern, sep, value = text.partition("=")
+    if not sep or not pattern or not value:
+        raise argparse.ArgumentTypeError(f"expected PATTERN=CACHE-CONTROL, got {text!r}")
+    return pattern, value
+
+
+def make_etag(st, encoding=None):
+    suffix = f"-{encoding}" if encoding else ""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}{suffix}"'
+
+
+def accepted_encodings(header):
+    """Content codings an Accept-Encoding header allows (q > 0)."""
+    accepted = set()
+    rejected = set()
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        (accepted if q > 0 else rejected).add(coding)
+    if "*" in accepted:
+        accepted.update(coding for coding, _ in PRECOMPRESSED if coding not in rejected)
+    return accepted
+
+
+def etag_matches(header, etag):
+    """Weak comparison of an If-None-Match header against our ETag."""
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def parse_range(header, size):
+    """
+    Parse a single "bytes=" range. Returns (start, end) inclusive, None to serve
+    the whole file (missing, malformed or multi-range headers), or "invalid"
+    when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return "invalid"
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return "invalid"
+    return start, min(end, size - 1)
+
+
+class HotFileCache:
+    """
+    Size-capped LRU of read-only memory maps of small files, keyed by path.
+    An entry is only used while the file's mtime and size match the stat the
+    request was validated against, so edited files are re-mapped.
+    """
+
+    def __init__(self, max_bytes=HOT_CACHE_BYTES, max_file_size=HOT_CACHE_MAX_FILE):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()  # path -> (mtime_ns, size, mmap)
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def cacheable(self, st):
+        return 0 < st.st_size <= self.max_file_size
+
+    def get(self, path, st):
+        """Return a memoryview of path's contents as of st, or None if it changed under us."""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return memoryview(entry[2])
+            self.misses += 1
+
+        with open(path, "rb") as f:
+            current = os.fstat(f.fileno())
+            if current.st_mtime_ns != st.st_mtime_ns or current.st_size != st.st_size:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old:
+                self.total -= old[1]
+            self.entries[path] = (st.st_mtime_ns, st.st_size, mapped)
+            self.total += st.st_size
+            # Evicted maps are not closed here: a response in another thread may
+            # still be writing from them, they are unmapped once unreferenced
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                _, (_, size, _) = self.entries.popitem(last=False)
+                self.total -= size
+        return memoryview(mapped)
+
+
+class MappedBody:
+    """Cached file contents returned by send_head in place of an open file."""
+
+    def __init__(self, view):
+        self.view = view
+
+    def close(self):
+        self.view.release()
+
+
+class StaticHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body go out in separate writes; with Nagle enabled a kept-alive
+    # connection stalls on the client's delayed ACK for every response
+    disable_nagle_algorithm = True
+    cache_policies = CACHE_POLICIES
+    hot_cache = None
+    sendfile_min_size = SENDFILE_MIN_SIZE
+    log_requests = True
+
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
         ".js": "application/javascript",
         ".css": "text/css",
+        ".json": "application/json",
+        ".webp": "image/webp",
+        ".avif": "image/avif",
     }
-)
 
-print(f"Server starting at http://localhost:{PORT}")
-print("Press Ctrl+C to quit")
+    def log_request(self, code="-", size="-"):
+        if self.log_requests:
+            super().log_request(code, size)
+
+    def send_head(self):
+        self.byte_range = None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split("?", 1)[0].endswith("/"):
+                # Let the base class send the trailing-slash redirect
+                return super().send_head()
+            for index in ("index.html", "index.htm"):
+                index_path = os.path.join(path, index)
+                if os.path.isfile(index_path):
+                    path = index_path
+                    break
+            else:
+                return self.list_directory(path)
+        if path.endswith("/"):
+            self.send_error(404, "File not found")
+            return None
+
+        self.vary = False
+        source_path = path
+        path, encoding = self.negotiate(source_path)
+
+        f = None
+        try:
+            st = os.stat(path)
+            if self.hot_cache is not None and self.hot_cache.cacheable(st):
+                view = self.hot_cache.get(path, st)
+                if view is not None:
+                    f = MappedBody(view)
+            if f is None:
+                f = open(path, "rb")
+                st = os.fstat(f.fileno())
+        except OSError:
+            if f is not None:
+                f.close()
+            self.send_error(404, "File not found")
+            return None
+
+        try:
+            etag = make_etag(st, encoding)
+            last_modified = formatdate(st.st_mtime, usegmt=True)
+            url_path = self.path.split("?", 1)[0]
+
+            if self.not_modified(etag, st.st_mtime):
+                f.close()
+                self.send_response(304)
+                self.send_validators(url_path, etag, last_modified)
+                self.end_headers()
+                return None
+
+            size = st.st_size
+            byte_range = None
+            if self.if_range_matches(etag, st.st_mtime):
+                byte_range = parse_range(self.headers.get("Range"), size)
+            if byte_range == "invalid":
+                f.close()
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.byte_range = byte_range
+            else:
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+            self.send_header("Content-type", self.guess_type(source_path))
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_validators(url_path, etag, last_modified)
+            self.end_headers()
+            return f
+        except BaseException:
+            f.close()
+            raise
+
+    def negotiate(self, path):
+        """
+        Pick the precompressed sibling of path the client prefers. Siblings only
+        count while they carry the source's mtime (see build_compressed.py).
+        Returns (path to serve, Content-Encoding or None) and sets self.vary
+        when the response depends on Accept-Encoding.
+        """
+        if os.path.splitext(path)[1] not in PRECOMPRESSED_TYPES:
+            return path, None
+        try:
+            source_mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return path, None
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding", ""))
+        for encoding, suffix in PRECOMPRESSED:
+            try:
+                if os.stat(path + suffix).st_mtime_ns != source_mtime:
+                    continue
+            except OSError:
+                continue
+            self.vary = True
+            if encoding in accepted:
+                return path + suffix, encoding
+        return path, None
+
+    def send_validators(self, url_path, etag, last_modified):
+        if self.vary:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", cache_control_for(url_path, self.cache_policies))
+
+    def not_modified(self, etag, mtime):
+        """Evaluate If-None-Match, or If-Modified-Since when no ETag was sent."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def if_range_matches(self, etag, mtime):
+        """A Range header only applies if If-Range (when sent) still matches."""
+        if_range = self.headers.get("If-Range")
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == etag
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_range).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, MappedBody):
+            if self.byte_range is None:
+                outputfile.write(source.view)
+            else:
+                start, end = self.byte_range
+                outputfile.write(source.view[start : end + 1])
+            return
+        try:
+            fileno = source.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # In-memory bodies such as directory listings
+            return super().copyfile(source, outputfile)
+
+        if self.byte_range is None:
+            offset, count = 0, os.fstat(fileno).st_size
+        else:
+            offset, count = self.byte_range[0], self.byte_range[1] - self.byte_range[0] + 1
+        if self.sendfile_min_size is not None and count >= self.sendfile_min_size:
+            # Headers are already on the wire (wfile is unbuffered), so the
+            # body can go straight from the file to the socket
+            self.connection.sendfile(source, offset, count)
+            return
+        source.seek(offset)
+        remaining = count
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+
+def make_server(
+    port=PORT,
+    bind="",
+    directory=".",
+    policies=None,
+    handler=StaticHandler,
+    hot_cache_bytes=HOT_CACHE_BYTES,
+    sendfile=True,
+    log_requests=True,
+):
+    """
+    Create a threaded server for directory; call serve_forever() on the result.
+    hot_cache_bytes=0 disables the hot-file cache, sendfile=False the sendfile path.
+    """
+    attrs = {
+        "log_requests": log_requests,
+        "hot_cache": HotFileCache(hot_cache_bytes) if hot_cache_bytes > 0 else None,
+        "sendfile_min_size": SENDFILE_MIN_SIZE if sendfile else None,
+    }
+    if policies:
+        attrs["cache_policies"] = list(policies) + CACHE_POLICIES
+    handler_class = type(handler.__name__, (handler,), attrs)
+
+    def factory(*args, **kwargs):
+        return handler_class(*args, directory=directory, **kwargs)
+
+    return http.server.ThreadingHTTPServer((bind, port), factory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the site locally")
+    parser.add_argument("--port", type=int, default=PORT, help=f"port to listen on (default: {PORT})")
+    parser.add_argument("--bind", default="", help="address to bind (default: all interfaces)")
+    parser.add_argument("--directory", default=".", help="directory to serve")
+    parser.add_argument(
+        "--cache-control",
+        type=parse_policy,
+        action="append",
+        metavar="PATTERN=VALUE",
+        help="extra Cache-Control policy, checked before the built-in ones",
+    )
+    parser.add_argument(
+        "--hot-cache-mb",
+        type=float,
+        default=HOT_CACHE_BYTES / (1024 * 1024),
+        help="memory for the hot-file cache in MiB, 0 to disable (default: %(default)g)",
+    )
+    parser.add_argument("--no-sendfile", action="store_true", help="copy files through Python")
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    args = parser.parse_args()
 
-with socketserver.TCPServer(("", PORT), Handler) as httpd:
-    httpd.serve_forever()
+    httpd = make_server(
+        args.port,
+        args.bind,
+        args.directory,
+        args.cache_control,
+        hot_cache_bytes=int(args.hot_cache_mb * 1024 * 1024),
+        sendfile=not args.no_sendfile,
+        log_requests=not args.quiet,
+    )
+    print(f"Server starting at http://localhost:{args.port}")
+    print("Press Ctrl+C to quit")
+    with httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
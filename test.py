@@ -1,56 +1,82 @@
 import os
-import io
 import sys
-import glob
-import requests
 import urllib.parse
-from PIL import Image
 
+import instrument
+import image_index
+from async_fetch import AsyncDownloader, FetchError
+from downloader import Downloader, Manifest
 
-def download_and_save(url, folder):
-    response = requests.get(url)
-    if response.status_code == 200:
-        image = Image.open(io.BytesIO(response.content))
-        fname = urllib.parse.unquote(os.path.basename(url).split(".")[0])  # decode URL encoding
-        output_filename = f"{fname}.png"
-        os.makedirs(folder, exist_ok=True)
-        image.save(os.path.join(folder, output_filename), "PNG")
-        print(f"Saved {output_filename} in {folder}")
-    else:
-        print(f"Failed to download {url}")
 
+def output_path(url, folder):
+    fname = urllib.parse.unquote(os.path.basename(url).split(".")[0])  # decode URL encoding
+    return os.path.join(folder, f"{fname}.png")
 
-def process_file(url_file, folder):
+
+def make_downloader(use_async=False):
+    """The threaded requests engine, or the asyncio engine with retries and a deadline."""
+    engine = AsyncDownloader if use_async else Downloader
+    return engine(manifest=Manifest())
+
+
+def download_and_save(url, folder, downloader=None):
+    if downloader is None:
+        with make_downloader() as downloader:
+            return download_and_save(url, folder, downloader)
+    try:
+        with instrument.span("download", image=url) as span:
+            result = downloader.download(url, output_path(url, folder))
+            span.set(bytes=result["bytes"])
+            return result
+    except (FetchError, OSError, ValueError) as e:
+        # OSError covers requests' errors; FetchError is the async engine's once
+        # retries or the deadline run out; ValueError an undecodable body
+        print(f"Failed to download {url}: {e}")
+        return None
+
+
+def process_file(url_file, folder, downloader=None):
     with open(url_file, "r") as f:
-        for line in f:
-            url = line.strip()
-            if url:
-                download_and_save(url, folder)
+        jobs = [(line.strip(), output_path(line.strip(), folder)) for line in f if line.strip()]
+
+    if downloader is None:
+        with make_downloader() as downloader:
+            return process_file(url_file, folder, downloader)
+    with instrument.span("download_all", image=url_file) as span:
+        summary = downloader.download_all(jobs)
+        span.set(bytes=summary["bytes"], files=summary["total"])
+    return summary
 
 
 def print_image_aspect_ratios():
+    # Dimensions come from the PNG/WebP headers only; no pixels are decoded
+    with instrument.span("aspect_ratios"):
+        images = image_index.scan_images(["classes", "subclasses"])
+    image_index.write_index(images)
+
     output_file = "aspect_ratios.txt"
     with open(output_file, "w") as f:
         for folder in ["classes", "subclasses"]:
-            image_files = glob.glob(os.path.join(folder, "*.png"))
             f.write(f"Directory: {folder}\n")
-            for image_path in image_files:
-                try:
-                    with Image.open(image_path) as img:
-                        w, h = img.size
-                        ratio = w / h if h != 0 else 0
-                        f.write(f"{os.path.basename(image_path)}: {ratio:.2f}\n")
-                except Exception as e:
-                    f.write(f"{os.path.basename(image_path)}: Error {e}\n")
+            for image_path, entry in images.items():
+                if not image_path.startswith(f"{folder}/"):
+                    continue
+                if "error" in entry:
+                    f.write(f"{os.path.basename(image_path)}: Error {entry['error']}\n")
+                else:
+                    f.write(f"{os.path.basename(image_path)}: {entry['ratio']:.2f}\n")
             f.write("\n")
-    print(f"Aspect ratios saved to {output_file}")
+    print(f"Aspect ratios saved to {output_file} and {image_index.INDEX_PATH}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == "aspect_ratios":
-        print_image_aspect_ratios()
-    else:
-        # Process 'classes' URLs
-        process_file("urls_classes.txt", "classes")
-        # Process 'subclasses' URLs
-        process_file("urls.txt", "subclasses")
+    with instrument.profiled():
+        if len(sys.argv) > 1 and sys.argv[1] == "aspect_ratios":
+            print_image_aspect_ratios()
+        else:
+            # --async opts into the asyncio engine
+            with make_downloader("--async" in sys.argv[1:]) as downloader:
+                # Process 'classes' URLs
+                process_file("urls_classes.txt", "classes", downloader)
+                # Process 'subclasses' URLs
+                process_file("urls.txt", "subclasses", downloader)
@@ -0,0 +1,252 @@
+"""
+Watch mode for the site's image data.
+
+Watches classes/ and subclasses/ for added, replaced or removed images, with
+inotify on Linux and by polling elsewhere (or with --poll). A burst of changes
+is collected until it has been quiet for --debounce seconds, then build.py
+runs in this process: the processing modules, the mask buffers and the digest
+of every unchanged file stay warm between rebuilds, and only the images whose
+content changed are decoded, detected, cropped and analyzed again.
+
+build.py replaces aspect_ratios.txt, image_bounds.json and image-offsets.json
+atomically, and only when they change; their precompressed siblings are
+refreshed after each rebuild so server.py never serves a stale one. server.py
+gives image-offsets.json a one-day max-age, so while iterating run it with
+--cache-control image-offsets.json=no-cache to see new offsets on reload.
+"""
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+
+import build
+import build_compressed
+import process_images
+
+
+WATCH_FOLDERS = ("classes", "subclasses")
+IMAGE_EXTENSIONS = (".png", ".webp")
+OUTPUTS = ("image_bounds.json", "image-offsets.json")
+
+DEBOUNCE = 0.5
+POLL_INTERVAL = 1.0
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+# A finished write, a rename in or out (how downloader.py saves) and a delete
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_image(name):
+    return name.endswith(IMAGE_EXTENSIONS)
+
+
+class InotifyWatcher:
+    """Changed image paths from Linux inotify, read through libc with ctypes."""
+
+    def __init__(self, folders):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for folder in folders:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, f"inotify_add_watch failed for {folder}")
+            self.folders[wd] = folder
+
+    def wait(self, timeout=None):
+        """Paths changed within timeout seconds (None blocks until a change)."""
+        changed = set()
+        while not changed:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return changed
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            changed = self.parse(data)
+        return changed
+
+    def parse(self, data):
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; the build finds the changes by content hash
+                changed.add("*")
+            elif mask & (IN_DELETE_SELF | IN_IGNORED):
+                print(f"Stopped watching {self.folders.get(wd)}: directory removed")
+            elif wd in self.folders and is_image(name):
+                changed.add(os.path.join(self.folders[wd], name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Changed image paths found by comparing (mtime, size) snapshots of the folders."""
+
+    def __init__(self, folders, interval=POLL_INTERVAL):
+        self.folders = folders
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for folder in self.folders:
+            try:
+                entries = list(os.scandir(folder))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if is_image(entry.name):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            snapshot = self.scan()
+            changed = {
+                path
+                for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            }
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(folders, poll=False, interval=POLL_INTERVAL):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as e:
+            # AttributeError: a libc without the inotify functions
+            print(f"inotify unavailable ({e}), polling every {interval:g}s instead")
+    return PollingWatcher(folders, interval)
+
+
+def collect_burst(watcher, debounce):
+    """Block for a change, then keep collecting until debounce seconds pass quietly."""
+    changed = watcher.wait()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+
+def refresh_compressed():
+    """Rewrite stale .gz/.br siblings of the rebuilt outputs."""
+    encoders = build_compressed.available_encoders()
+    for path in OUTPUTS:
+        if os.path.exists(path):
+            build_compressed.build_asset(path, encoders)
+
+
+def rebuild(changed, args, digests):
+    start = time.perf_counter()
+    for path in sorted(changed - {"*"}):
+        if os.path.exists(path):
+            print(f"Changed: {path}")
+        else:
+            print(f"Removed: {path}")
+            # Drop the crop too, so processed/ mirrors the sources
+            clipped = process_images.clipped_path(path)
+            if os.path.exists(clipped):
+                os.remove(clipped)
+    ok = build.build(
+        jobs=args.jobs,
+        smooth_contours=not args.no_smooth,
+        coarse_scale=args.coarse_scale,
+        digests=digests,
+    )
+    refresh_compressed()
+    print(f"Rebuilt in {(time.perf_counter() - start) * 1e3:.0f} ms; watching for changes")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the image data when source images change")
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=DEBOUNCE,
+        help=f"seconds without changes before rebuilding (default: {DEBOUNCE:g})",
+    )
+    parser.add_argument("--poll", action="store_true", help="poll instead of using inotify")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help=f"seconds between polls (default: {POLL_INTERVAL:g})",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="worker processes per rebuild (default: 1, in process)"
+    )
+    parser.add_argument(
+        "--no-smooth", action="store_true", help="use the projection path instead of contours"
+    )
+    parser.add_argument(
+        "--coarse-scale",
+        type=int,
+        choices=process_images.COARSE_SCALES,
+        default=1,
+        help="pyramid level for the projection path",
+    )
+    args = parser.parse_args()
+
+    folders = [folder for folder in WATCH_FOLDERS if os.path.isdir(folder)]
+    if not folders:
+        print(f"None of {', '.join(WATCH_FOLDERS)} exist")
+        return 1
+
+    digests = {}
+    watcher = make_watcher(folders, args.poll, args.poll_interval)
+    try:
+        # Start from up-to-date outputs; this also warms the caches and digests
+        rebuild(set(), args, digests)
+        print(f"Watching {', '.join(folders)} ({type(watcher).__name__}); Ctrl-C to stop")
+        while True:
+            rebuild(collect_burst(watcher, args.debounce), args, digests)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())